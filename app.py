@@ -1,14 +1,79 @@
 # app.py
-from flask import Flask, request, send_file, render_template_string, send_from_directory
-import qrcode
-from PIL import Image, ImageDraw, ImageFont
+from flask import (Flask, Response, jsonify, request, render_template_string, send_file,
+                   send_from_directory, stream_with_context, url_for)
+import base64
+import json
+import logging
 import zipfile
 import os
-import io
-import pandas as pd
+import shutil
+import tempfile
+import uuid
+from functools import partial
+
+import qrcode
+
+from cache import RenderCache
+from encoder import encode_batch
+from engine import DEFAULT_STYLE, RenderEngine
+from ingest import IngestError, detect_encoding, read_tiffin_rows
+from jobs import JobManager
+from metrics import NULL_TIMER, StageTimer, registry, track_request
+from render import render_qr_png, render_tile_svg, tile_cache_key
+from sheets import SheetLayout, iter_page_pngs, iter_pages, stream_pdf
+from zipstream import stream_zip
+
+# Log records from every module go to gunicorn's error log at its level when
+# running under gunicorn, and to stderr otherwise. Set up before the app so
+# Flask does not add a handler of its own to app.logger.
+gunicorn_logger = logging.getLogger('gunicorn.error')
+if gunicorn_logger.handlers:
+    logging.getLogger().handlers = gunicorn_logger.handlers
+    logging.getLogger().setLevel(gunicorn_logger.level)
+elif not logging.getLogger().handlers:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10 MB file limit
+# PNGs are already deflate-compressed, so storing them is nearly as small and much cheaper
+app.config['QR_ZIP_COMPRESSION'] = zipfile.ZIP_STORED
+# 0 means one render process per core
+app.config['QR_RENDER_WORKERS'] = int(os.environ.get("QR_RENDER_WORKERS", 0))
+app.config['QR_RENDER_BATCH_SIZE'] = int(os.environ.get("QR_RENDER_BATCH_SIZE", 256))
+# Accepted header names for the tiffin number column, compared ignoring case and
+# whitespace (so the "Tiffin \nnumber" header of the Thaali sheet matches)
+app.config['QR_TIFFIN_COLUMNS'] = os.environ.get("QR_TIFFIN_COLUMNS", "Tiffin Number").split(',')
+# Finished tiles are cached per worker in memory, and optionally on disk in a
+# directory shared by all gunicorn workers
+app.config['QR_CACHE_MEMORY_BYTES'] = int(os.environ.get("QR_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+app.config['QR_CACHE_DIR'] = os.environ.get("QR_CACHE_DIR")
+app.config['QR_CACHE_DISK_BYTES'] = int(os.environ.get("QR_CACHE_DISK_BYTES", 1024 * 1024 * 1024))
+
+render_cache = RenderCache(memory_bytes=app.config['QR_CACHE_MEMORY_BYTES'],
+                           disk_dir=app.config['QR_CACHE_DIR'],
+                           disk_bytes=app.config['QR_CACHE_DISK_BYTES'])
+render_engine = RenderEngine(workers=app.config['QR_RENDER_WORKERS'],
+                             batch_size=app.config['QR_RENDER_BATCH_SIZE'],
+                             cache=render_cache)
+
+# Limits for the /qr single-code and batch endpoints
+app.config['QR_MAX_PAYLOAD_LENGTH'] = 1000
+app.config['QR_BATCH_MAX_PAYLOADS'] = int(os.environ.get("QR_BATCH_MAX_PAYLOADS", 1000))
+
+# Default page grid for the "pdf" and "pages" outputs of /generate
+app.config['QR_SHEET_LAYOUT'] = {'page_size': 'A4', 'columns': 4, 'rows': 6, 'dpi': 300,
+                                 'margin_mm': 10, 'gutter_mm': 4}
+
+# /metrics sums counters over the processes sharing this directory; by
+# default one directory per gunicorn master (the workers' parent process)
+app.config['QR_METRICS_DIR'] = os.environ.get(
+    "QR_METRICS_DIR", os.path.join(tempfile.gettempdir(), f'qr-metrics-{os.getppid()}'))
+registry.share(app.config['QR_METRICS_DIR'], cache_stats=render_cache.stats)
+
+# Background jobs; finished archives are deleted QR_JOB_TTL seconds after completion
+app.config['QR_JOBS_DIR'] = os.environ.get("QR_JOBS_DIR", os.path.join(tempfile.gettempdir(), 'qr-jobs'))
+app.config['QR_JOB_WORKERS'] = int(os.environ.get("QR_JOB_WORKERS", 2))
+app.config['QR_JOB_TTL'] = int(os.environ.get("QR_JOB_TTL", 3600))
 
 HTML_TEMPLATE = """
 <!doctype html>
@@ -29,6 +94,9 @@ HTML_TEMPLATE = """
            padding: 10px 20px; border-radius: 6px; font-size: 16px; cursor: pointer;
            transition: background-color 0.3s ease; }
     input[type="submit"]:hover { background-color: #1e5faa; }
+    select { margin-bottom: 20px; padding: 6px; border-radius: 6px; }
+    label { color: #555; font-size: 14px; margin-bottom: 20px; }
+    #job-progress { color: #555; font-size: 14px; margin-top: 20px; display: none; }
   </style>
 </head>
 <body>
@@ -52,83 +120,378 @@ HTML_TEMPLATE = """
   <p style="font-size: 13px; color: #c0392b; margin-top: 5px; margin-bottom: 20px;">
     ⚠️ Please do not modify the first row (header) of the CSV. Just fill in your Tiffin numbers below it.
   </p>
-  <form action="/generate" method="post" enctype="multipart/form-data">
+  <form id="upload-form" action="/generate" method="post" enctype="multipart/form-data">
     <input type="file" name="file" accept=".csv" required>
+    <select name="output">
+      <option value="zip">ZIP of QR PNGs (one per row)</option>
+      <option value="pdf">Printable PDF label sheets (A4, 4 &times; 6)</option>
+      <option value="pages">ZIP of PNG label sheets (A4, 4 &times; 6)</option>
+    </select>
+    <label><input type="checkbox" id="background-job"> Process in the background (recommended for large files)</label>
     <input type="submit" value="Generate QR Codes">
   </form>
+  <p id="job-progress"></p>
+  <script>
+    // Background mode queues a job, polls its progress and downloads the
+    // archive when it is ready, so a dropped connection loses no work
+    const form = document.getElementById('upload-form');
+    const progress = document.getElementById('job-progress');
+    const background = document.getElementById('background-job');
+    // Jobs only produce the ZIP of PNGs
+    const syncBackground = () => {
+      background.disabled = form.elements.output.value !== 'zip';
+      if (background.disabled) background.checked = false;
+    };
+    form.elements.output.addEventListener('change', syncBackground);
+    syncBackground();
+    // JSON body of a response, or null for anything else (a proxy error
+    // page, or the HTML 413 for an oversized upload)
+    const readJson = async (response) => {
+      const type = response.headers.get('Content-Type') || '';
+      if (!type.includes('application/json')) return null;
+      try { return await response.json(); } catch (e) { return null; }
+    };
+    const failure = (response, body) =>
+      (body && body.error) || (response.status === 413 ? 'The file is too large.'
+                                                       : `Request failed (HTTP ${response.status}).`);
+    form.addEventListener('submit', async (event) => {
+      if (!background.checked) return;
+      event.preventDefault();
+      progress.style.display = 'block';
+      progress.textContent = 'Uploading...';
+      let response;
+      try {
+        response = await fetch('/jobs', { method: 'POST', body: new FormData(form) });
+      } catch (e) {
+        progress.textContent = 'Upload failed. Please check your connection and try again.';
+        return;
+      }
+      const job = await readJson(response);
+      if (!response.ok || !job) { progress.textContent = failure(response, job); return; }
+      const poll = async () => {
+        let response;
+        try {
+          response = await fetch(job.status_url);
+        } catch (e) {
+          // The job keeps running on the server; try again shortly
+          setTimeout(poll, 5000);
+          return;
+        }
+        const status = await readJson(response);
+        if (!response.ok || !status) { progress.textContent = failure(response, status); return; }
+        const failed = status.error_count ? ` (${status.error_count} rows failed)` : '';
+        if (status.state === 'done') {
+          progress.textContent = `Done: ${status.rows_done} rows${failed}. Downloading...`;
+          window.location = status.download_url;
+        } else if (status.state === 'failed') {
+          progress.textContent = `Job failed: ${status.failure}`;
+        } else {
+          const total = status.rows_total === null ? '?' : status.rows_total;
+          progress.textContent = `Generating: ${status.rows_done} / ${total} rows${failed}`;
+          setTimeout(poll, 1000);
+        }
+      };
+      poll();
+    });
+  </script>
 </body>
 </html>
 """
 
+def iter_qr_entries(rows, on_result=None, stats=None):
+    # Rendered lazily so the archive can be streamed one entry at a time
+    for row_number, tiffin_number, png, error in render_engine.render(rows, stats):
+        if on_result is not None:
+            on_result(row_number, error)
+        if error is not None:
+            app.logger.warning('Error on row %d: %s', row_number, error)
+            continue
+        yield f'qr_{row_number}_tiffin_{tiffin_number}.png', png
+
+job_manager = JobManager(app.config['QR_JOBS_DIR'], iter_qr_entries,
+                         workers=app.config['QR_JOB_WORKERS'], ttl=app.config['QR_JOB_TTL'],
+                         compression=app.config['QR_ZIP_COMPRESSION'])
+
 @app.route('/')
 def index():
     return render_template_string(HTML_TEMPLATE)
 
-@app.route('/generate', methods=['POST'])
-def generate_qr():
+def tiffin_columns():
+    # An upload may name its own tiffin number column with a "column" form field
+    column = request.form.get('column', '').strip()
+    return ([column] if column else []) + app.config['QR_TIFFIN_COLUMNS']
+
+def load_upload(timer=NULL_TIMER):
+    # Shared by /generate and /jobs; returns (upload, rows, error message).
+    # Flask closes request files as soon as the view returns, before a
+    # streamed response has been read, so rows come from a private copy.
+    # The up-front parsing is charged to timer's csv_parse stage.
     if 'file' not in request.files:
-        return 'No file part in request.'
+        return None, None, 'No file part in request.'
     file = request.files['file']
 
     if file.filename == '' or not file.filename.lower().endswith('.csv'):
-        return 'Invalid file type. Please upload a .csv file.'
+        return None, None, 'Invalid file type. Please upload a .csv file.'
 
+    upload = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    shutil.copyfileobj(file.stream, upload)
+    upload.seek(0)
     try:
-        df = pd.read_csv(file)
-    except Exception as e:
-        return f'Failed to read CSV file. Error: {str(e)}'
+        # A parse-only pass first, so a malformed line anywhere in the file
+        # is reported here rather than partway through a streamed response
+        with timer.stage('csv_parse'):
+            encoding = detect_encoding(upload)
+            for _ in read_tiffin_rows(upload, tiffin_columns(), encoding):
+                pass
+            upload.seek(0)
+            rows = read_tiffin_rows(upload, tiffin_columns(), encoding)
+    except IngestError as e:
+        upload.close()
+        return None, None, str(e)
+    return upload, rows, None
+
+def sheet_layout():
+    # Layout fields on the form override the configured defaults
+    options = dict(app.config['QR_SHEET_LAYOUT'])
+    for field, kind in (('page_size', str), ('columns', int), ('rows', int), ('dpi', int),
+                        ('margin_mm', float), ('gutter_mm', float)):
+        value = request.form.get(field, '').strip()
+        if value:
+            options[field] = kind(value)
+    return SheetLayout(**options)
+
+@app.route('/generate', methods=['POST'])
+def generate_qr():
+    output = request.form.get('output', 'zip')
+    if output not in ('zip', 'pdf', 'pages'):
+        return 'Invalid output format. Use "zip", "pdf" or "pages".'
+    layout = None
+    if output != 'zip':
+        try:
+            layout = sheet_layout()
+        except (ValueError, OverflowError) as e:
+            return f'Invalid sheet layout. Error: {str(e)}'
+
+    # The request's stats only open once the response is streamed
+    parse_timer = StageTimer()
+    upload, rows, error = load_upload(parse_timer)
+    if error:
+        return error
+
+    # Nothing below runs until the response is iterated
+    compression = app.config['QR_ZIP_COMPRESSION']
+    if output == 'zip':
+        mimetype, filename = 'application/zip', 'qr_codes.zip'
+    elif output == 'pdf':
+        mimetype, filename = 'application/pdf', 'qr_labels.pdf'
+    else:
+        mimetype, filename = 'application/zip', 'qr_label_pages.zip'
 
-    # Only one required column now
-    if 'Tiffin Number' not in df.columns:
-        return 'CSV must have a header named "Tiffin Number".'
+    def generate():
+        with upload, track_request(output) as stats:
+            stats.merge(parse_timer.seconds)
+            entries = iter_qr_entries(rows, stats=stats)
+            if output == 'zip':
+                body = stream_zip(entries, compression, stats)
+            else:
+                # Label sheets: each tile is pasted into a page grid instead
+                # of becoming its own file
+                pages = iter_pages((png for _, png in entries), layout)
+                if output == 'pdf':
+                    body = stream_pdf(pages, layout)
+                else:
+                    body = stream_zip(iter_page_pngs(pages, layout), compression, stats)
+            for chunk in body:
+                stats.bytes += len(chunk)
+                yield chunk
 
-    zip_buffer = io.BytesIO()
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+def job_urls(job_id):
+    return {'status_url': url_for('job_status', job_id=job_id),
+            'download_url': url_for('job_download', job_id=job_id)}
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    if request.form.get('output', 'zip') != 'zip':
+        return jsonify({'error': 'Background jobs produce a ZIP of PNGs only.'}), 400
+    upload, _, error = load_upload()
+    if error:
+        return jsonify({'error': error}), 400
+    # The header checked out; the job re-reads the whole upload from disk
+    with upload:
+        upload.seek(0)
+        job_id = job_manager.submit(upload, partial(read_tiffin_rows, columns=tiffin_columns()))
+    return jsonify({'job_id': job_id, **job_urls(job_id)}), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    status = job_manager.status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown or expired job.'}), 404
+    status.pop('pid', None)
+    return jsonify({**status, **job_urls(job_id)})
+
+@app.route('/jobs/<job_id>/download')
+def job_download(job_id):
+    path = job_manager.archive_path(job_id)
+    if path is None:
+        return jsonify({'error': 'Archive is not ready, or the job has expired.'}), 404
+    # conditional=True answers Range requests, so interrupted downloads can resume
+    return send_file(path, mimetype='application/zip', download_name='qr_codes.zip',
+                     as_attachment=True, conditional=True)
+
+ERROR_CORRECTION_LEVELS = {'L': qrcode.constants.ERROR_CORRECT_L, 'M': qrcode.constants.ERROR_CORRECT_M,
+                           'Q': qrcode.constants.ERROR_CORRECT_Q, 'H': qrcode.constants.ERROR_CORRECT_H}
+IMAGE_TYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+def qr_style(options):
+    # Style parameters for /qr; defaults match the tiles /generate produces.
+    # Returns (image format, style) or raises ValueError.
+    image_format = str(options.get('format', 'png')).lower()
+    if image_format not in IMAGE_TYPES:
+        raise ValueError('format must be "png" or "svg".')
+    style = dict(DEFAULT_STYLE)
+    for field, low, high in (('box_size', 1, 40), ('border', 0, 20)):
+        if field in options:
+            try:
+                style[field] = int(options[field])
+            except (TypeError, ValueError):
+                raise ValueError(f'{field} must be a whole number.')
+            if not low <= style[field] <= high:
+                raise ValueError(f'{field} must be between {low} and {high}.')
+    level = str(options.get('ec', 'L')).upper()
+    if level not in ERROR_CORRECTION_LEVELS:
+        raise ValueError('ec must be one of L, M, Q or H.')
+    style['error_correction'] = ERROR_CORRECTION_LEVELS[level]
+    style['label'] = str(options.get('label', '1')).lower() not in ('0', 'false', 'no', 'off')
+    return image_format, style
+
+def render_single(payload, image_format, style):
+    # The render path shared by /qr and /qr/batch for one payload
+    if image_format == 'svg':
+        modules = encode_batch([payload], style['error_correction'], style['border'])[0]
+        return render_tile_svg(modules, payload, style['box_size'], style['label'])
+    key = tile_cache_key(payload, **style)
+    png = render_cache.get(key)
+    if png is None:
+        png = render_qr_png(payload, **style)
+        render_cache.put(key, png)
+    return png
+
+def cacheable(response, etag):
+    # Output depends only on the inputs hashed into the ETag, so any cache
+    # may keep it indefinitely
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/qr/<path:payload>')
+def single_qr(payload):
+    if len(payload) > app.config['QR_MAX_PAYLOAD_LENGTH']:
+        return jsonify({'error': 'Payload is too long.'}), 400
     try:
-        with zipfile.ZipFile(zip_buffer, 'w') as zipf:
-            for i, row in df.iterrows():
-                try:
-                    tiffin_number = row['Tiffin Number']
-
-                    # QR only encodes the tiffin number
-                    qr = qrcode.QRCode(
-                        version=1,
-                        error_correction=qrcode.constants.ERROR_CORRECT_L,
-                        box_size=6,
-                        border=2
-                    )
-                    qr.add_data(str(tiffin_number))
-                    qr.make(fit=True)
-                    qr_img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
-
-                    # add a label below
-                    label_height = 50
-                    final_img = Image.new("RGB", (qr_img.width, qr_img.height + label_height), "white")
-                    final_img.paste(qr_img, (0, 0))
-
-                    draw = ImageDraw.Draw(final_img)
-                    try:
-                        font = ImageFont.truetype("arial.ttf", 22)
-                    except:
-                        font = ImageFont.load_default()
-
-                    label_text = f"Tiffin #: {tiffin_number}"
-                    text_box = draw.textbbox((0, 0), label_text, font=font)
-                    text_width = text_box[2] - text_box[0]
-                    draw.text(((qr_img.width - text_width) // 2, qr_img.height + 10),
-                              label_text, fill="black", font=font)
-
-                    img_byte_arr = io.BytesIO()
-                    final_img.save(img_byte_arr, format='PNG')
-                    zipf.writestr(f'qr_{i+1}_tiffin_{tiffin_number}.png', img_byte_arr.getvalue())
-                except Exception as qr_err:
-                    print(f"Error on row {i+1}: {qr_err}")
-                    continue
+        image_format, style = qr_style(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    etag = tile_cache_key(payload, image_format=image_format, **style)
+    # Answer revalidations before doing any rendering. If-None-Match uses
+    # weak comparison: proxies that compress the body hand out W/"..." tags
+    if request.if_none_match.contains_weak(etag):
+        return cacheable(Response(status=304), etag)
+    try:
+        body = render_single(payload, image_format, style)
     except Exception as e:
-        return f"An error occurred while generating QR codes: {str(e)}"
+        return jsonify({'error': f'Could not render QR code. Error: {str(e)}'}), 400
+    return cacheable(Response(body, mimetype=IMAGE_TYPES[image_format]), etag)
+
+@app.route('/qr/batch', methods=['POST'])
+def batch_qr():
+    # Body: {"payloads": [...], "format": "png", "box_size": 6, ...} or a bare
+    # list. Answers NDJSON (one base64 image per line) unless the client
+    # accepts multipart/mixed.
+    body = request.get_json(silent=True)
+    options = body if isinstance(body, dict) else {'payloads': body}
+    payloads = options.get('payloads')
+    if not isinstance(payloads, list) or not payloads:
+        return jsonify({'error': 'Send a JSON list of payloads, or {"payloads": [...]}.'}), 400
+    if len(payloads) > app.config['QR_BATCH_MAX_PAYLOADS']:
+        return jsonify({'error': f'At most {app.config["QR_BATCH_MAX_PAYLOADS"]} payloads per batch.'}), 400
+    # Numbers are accepted as their JSON text; null, booleans, lists and
+    # objects have no sensible payload
+    if not all(isinstance(payload, (str, int, float)) and not isinstance(payload, bool)
+               for payload in payloads):
+        return jsonify({'error': 'Every payload must be a string or a number.'}), 400
+    payloads = [str(payload) for payload in payloads]
+    if any(len(payload) > app.config['QR_MAX_PAYLOAD_LENGTH'] for payload in payloads):
+        return jsonify({'error': 'A payload is too long.'}), 400
+    try:
+        image_format, style = qr_style(options)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    content_type = IMAGE_TYPES[image_format]
+
+    def results():
+        # PNGs go through the bulk engine (cache, pool, de-duplication);
+        # SVGs are cheap enough to build in-process
+        if image_format == 'png':
+            rows = enumerate(payloads)
+            for index, payload, png, error in render_engine.render(rows, style=style):
+                yield index, payload, png, error
+            return
+        for index, payload in enumerate(payloads):
+            try:
+                yield index, payload, render_single(payload, image_format, style), None
+            except Exception as e:
+                yield index, payload, None, repr(e)
+
+    def etag_for(payload):
+        return tile_cache_key(payload, image_format=image_format, **style)
+
+    if request.accept_mimetypes.best_match(['application/x-ndjson', 'multipart/mixed']) == 'multipart/mixed':
+        boundary = uuid.uuid4().hex
+
+        def generate():
+            for index, payload, data, error in results():
+                if error is not None:
+                    headers = f'Content-Type: application/json\r\nX-QR-Index: {index}\r\n'
+                    data = json.dumps({'index': index, 'payload': payload, 'error': error}).encode()
+                else:
+                    headers = (f'Content-Type: {content_type}\r\nX-QR-Index: {index}\r\n'
+                               f'ETag: "{etag_for(payload)}"\r\n')
+                yield f'--{boundary}\r\n{headers}\r\n'.encode() + data + b'\r\n'
+            yield f'--{boundary}--\r\n'.encode()
+
+        return Response(stream_with_context(generate()),
+                        mimetype=f'multipart/mixed; boundary={boundary}')
+
+    def generate():
+        for index, payload, data, error in results():
+            if error is not None:
+                line = {'index': index, 'payload': payload, 'error': error}
+            else:
+                line = {'index': index, 'payload': payload, 'content_type': content_type,
+                        'etag': etag_for(payload), 'data': base64.b64encode(data).decode('ascii')}
+            yield json.dumps(line) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.after_request
+def publish_metrics(response):
+    # Keeps this worker's share of /metrics current, cache counters included
+    registry.save(every=1.0)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    return Response(registry.render(),
+                    mimetype='text/plain; version=0.0.4')
 
-    zip_buffer.seek(0)
-    return send_file(zip_buffer, mimetype='application/zip',
-                     download_name='qr_codes.zip', as_attachment=True)
+@app.route('/cache-stats')
+def cache_stats():
+    # Counters are per gunicorn worker; the disk figures are shared
+    return jsonify(render_cache.stats())
 
 @app.route('/sample-template')
 def download_sample():
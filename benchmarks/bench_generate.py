@@ -0,0 +1,139 @@
+# benchmarks/bench_generate.py
+"""Reproducible throughput benchmark for /generate.
+
+Generates seeded synthetic CSVs and posts each one to /generate through the
+Flask test client, in a fresh interpreter per case so peak RSS is not
+inherited from earlier cases. Reports rows/sec and peak RSS of the request
+process and of its render workers.
+
+    python benchmarks/bench_generate.py
+    python benchmarks/bench_generate.py --rows 1000 10000 --payloads numeric --workers 4
+    python benchmarks/bench_generate.py --json results.json
+
+The tile cache is disabled unless --cache is given, so repeated runs measure
+rendering rather than cache hits.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import string
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PAYLOADS = {
+    # Tiffin-style numbers
+    'numeric': lambda rng: str(rng.randint(1, 99999)),
+    # Long mixed payloads that take the general qrcode path
+    'alnum': lambda rng: ''.join(rng.choice(string.ascii_letters + string.digits) for _ in range(48)),
+}
+
+
+def write_csv(path, rows, payload, seed):
+    rng = random.Random(seed)
+    make = PAYLOADS[payload]
+    with open(path, 'w') as f:
+        f.write('Tiffin Number\n')
+        for _ in range(rows):
+            f.write(make(rng) + '\n')
+
+
+def run_case(csv_path, output):
+    # Runs in the child interpreter; configuration arrives via the environment
+    sys.path.insert(0, ROOT)
+    import app as app_module
+
+    with open(csv_path, 'rb') as f:
+        data = f.read()
+    client = app_module.app.test_client()
+    start = time.perf_counter()
+    response = client.post('/generate', data={'file': (io.BytesIO(data), 'bench.csv'), 'output': output},
+                           content_type='multipart/form-data', buffered=False)
+    size = sum(len(chunk) for chunk in response.response)
+    elapsed = time.perf_counter() - start
+    worker_rss = worker_peak_rss_mb(app_module.render_engine)
+    app_module.render_engine.shutdown()
+    # ru_maxrss is in kilobytes on Linux
+    print(json.dumps({
+        'seconds': elapsed,
+        'bytes': size,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_worker_rss_mb': worker_rss,
+    }))
+
+
+def worker_peak_rss_mb(engine):
+    # Render workers are started by a fork server rather than by this
+    # process, so RUSAGE_CHILDREN never sees them; read their high-water
+    # mark from /proc while they are still alive
+    pool = engine._pool
+    peak = 0
+    for pid in (pool._processes or {}) if pool is not None else ():
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        peak = max(peak, int(line.split()[1]) / 1024)
+        except OSError:
+            continue
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--payloads', nargs='+', choices=sorted(PAYLOADS), default=sorted(PAYLOADS, reverse=True))
+    parser.add_argument('--output', choices=('zip', 'pdf', 'pages'), default='zip')
+    parser.add_argument('--workers', type=int, default=0, help='render processes (0 = one per core)')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--cache', action='store_true', help='leave the in-memory tile cache enabled')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--run-case', nargs=2, metavar=('CSV', 'OUTPUT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        run_case(*args.run_case)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ,
+                   QR_RENDER_WORKERS=str(args.workers),
+                   QR_RENDER_BATCH_SIZE=str(args.batch_size),
+                   QR_JOBS_DIR=os.path.join(workdir, 'jobs'))
+        env.pop('QR_CACHE_DIR', None)
+        if not args.cache:
+            env['QR_CACHE_MEMORY_BYTES'] = '0'
+
+        print(f"{'payload':<8} {'rows':>7} {'seconds':>8} {'rows/s':>9} {'MB out':>7} "
+              f"{'peak RSS':>9} {'worker RSS':>10}")
+        for payload in args.payloads:
+            for rows in args.rows:
+                csv_path = os.path.join(workdir, f'{payload}_{rows}.csv')
+                write_csv(csv_path, rows, payload, args.seed)
+                completed = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--run-case', csv_path, args.output],
+                    env=env, cwd=ROOT, capture_output=True, text=True, check=True)
+                # The app logs to stderr, so stdout holds only the case result
+                case = json.loads(completed.stdout.strip().splitlines()[-1])
+                case.update(payload=payload, rows=rows, output=args.output, workers=args.workers,
+                            rows_per_second=rows / case['seconds'])
+                results.append(case)
+                print(f"{payload:<8} {rows:>7} {case['seconds']:>8.2f} {case['rows_per_second']:>9.0f} "
+                      f"{case['bytes'] / 1e6:>7.1f} {case['peak_rss_mb']:>8.0f}M "
+                      f"{case['peak_worker_rss_mb']:>9.0f}M", flush=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+# cache.py
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: the disk tier is then only safe within one process
+    fcntl = None
+
+# Running byte total of the disk tier, shared by every process using the directory
+DISK_TOTAL_NAME = 'disk_total'
+
+
+def cache_key(*parts):
+    # Content address for one rendered tile; every input that changes the
+    # output bytes must be part of it
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """Finished PNG bytes keyed by cache_key().
+
+    An in-memory LRU bounded by total bytes sits in front of an optional
+    disk directory that several processes may share. The disk tier is capped
+    by size too; the least recently used files are removed first. Its size
+    is tracked in a locked file in the directory rather than per process, so
+    the cap holds across all the workers sharing it.
+    """
+
+    def __init__(self, memory_bytes=64 * 1024 * 1024, disk_dir=None,
+                 disk_bytes=1024 * 1024 * 1024):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(
+            ('memory_hits', 'disk_hits', 'misses', 'memory_evictions', 'disk_evictions'), 0)
+        self._disk_lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            # Only scans the directory if no total has been recorded yet
+            with self._disk_total():
+                pass
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return data
+        data = self._disk_get(key)
+        with self._lock:
+            if data is None:
+                self.counters['misses'] += 1
+                return None
+            self.counters['disk_hits'] += 1
+            self._memory_put(key, data)
+        return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._memory_put(key, data)
+        self._disk_put(key, data)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update(memory_entries=len(self._entries), memory_bytes=self._size,
+                         memory_limit_bytes=self.memory_bytes)
+        if self.disk_dir:
+            with self._disk_total() as total:
+                stats.update(disk_bytes=total[0], disk_limit_bytes=self.disk_bytes)
+        return stats
+
+    def _memory_put(self, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._size -= len(previous)
+        self._entries[key] = data
+        self._size += len(data)
+        while self._size > self.memory_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self.counters['memory_evictions'] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f'{key}.png')
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Bump the mtime so eviction sees this entry as recently used
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def _disk_put(self, key, data):
+        if not self.disk_dir or len(data) > self.disk_bytes:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so other workers never read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._disk_total() as total:
+            total[0] += len(data)
+            if total[0] > self.disk_bytes:
+                total[0] = self._disk_evict()
+
+    @contextmanager
+    def _disk_total(self):
+        # Holds the cross-process lock and yields [total bytes on disk];
+        # whatever the list holds on exit is written back
+        with self._disk_lock, open(os.path.join(self.disk_dir, DISK_TOTAL_NAME), 'a+') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                before = int(f.read())
+            except ValueError:
+                # A new directory, or one written before the total was kept
+                before = None
+            total = [before if before is not None else sum(size for _, size, _ in self._disk_files())]
+            yield total
+            if total[0] != before:
+                f.seek(0)
+                f.truncate()
+                f.write(str(total[0]))
+                f.flush()
+
+    def _disk_files(self):
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if not name.endswith('.png'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _disk_evict(self):
+        # Called with the shared total locked. Rescans so the total is
+        # corrected against what is really on disk, and trims to 90% so the
+        # rescan is not repeated on every write; returns the new total.
+        files = sorted(self._disk_files(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in files)
+        target = self.disk_bytes * 0.9
+        evicted = 0
+        for path, size, _ in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        with self._lock:
+            self.counters['disk_evictions'] += evicted
+        return total
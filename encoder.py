@@ -0,0 +1,271 @@
+# encoder.py
+import logging
+from bisect import bisect_left
+from functools import lru_cache
+
+import numpy as np
+import qrcode
+from qrcode import LUT, base, util
+
+logger = logging.getLogger(__name__)
+
+# Numeric character counts stay 10 bits wide up to version 9; longer payloads
+# are rare enough to leave to the qrcode library
+MAX_VERSION = 9
+# Values scored together at once; bounds the (values x 8 masks) module stack
+CHUNK_SIZE = 256
+
+EXP = np.array(base.EXP_TABLE[:255], dtype=np.int64)
+LOG = np.array(base.LOG_TABLE, dtype=np.int64)
+
+FINDER_LIKE = (
+    np.array([1, 0, 1, 1, 1, 0, 1, 0, 0, 0, 0], dtype=bool),
+    np.array([0, 0, 0, 0, 1, 0, 1, 1, 1, 0, 1], dtype=bool),
+)
+
+
+def make_modules(value, error_correction=qrcode.constants.ERROR_CORRECT_L, border=2):
+    # General path through the qrcode library
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=error_correction,
+        border=border
+    )
+    qr.add_data(str(value))
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+
+def _numeric_version(length, error_correction):
+    # Same search as QRCode.best_fit for a single numeric chunk
+    bits = 4 + 10 + 10 * (length // 3) + (0, 4, 7)[length % 3]
+    version = bisect_left(util.BIT_LIMIT_TABLE[error_correction], bits, 1)
+    return version if version <= MAX_VERSION else None
+
+
+def _rs_remainder(data, generator):
+    # Polynomial long division over GF(256), one codeword column at a time
+    # for the whole batch
+    generator_log = LOG[generator[1:]]
+    remainder = np.zeros((data.shape[0], len(generator) - 1), dtype=np.int64)
+    for i in range(data.shape[1]):
+        factor = data[:, i] ^ remainder[:, 0]
+        remainder[:, :-1] = remainder[:, 1:]
+        remainder[:, -1] = 0
+        term = EXP[(LOG[factor][:, None] + generator_log) % 255]
+        term[factor == 0] = 0
+        remainder ^= term
+    return remainder
+
+
+def _lost_points(modules):
+    # Vectorised equivalent of qrcode.util.lost_point for a stack of symbols
+    count = modules.shape[-1]
+    points = np.zeros(modules.shape[0], dtype=np.int64)
+
+    for grid in (modules, modules.transpose(0, 2, 1)):
+        # Runs of five or more: a run of n scores n - 2, which is one point
+        # per uniform 5-wide window plus two per run
+        same = grid[:, :, 1:] == grid[:, :, :-1]
+        window = same[:, :, :-3] & same[:, :, 1:-2] & same[:, :, 2:-1] & same[:, :, 3:]
+        run_start = np.ones_like(window)
+        run_start[:, :, 1:] = ~same[:, :, :-4]
+        points += window.sum(axis=(1, 2)) + 2 * (window & run_start).sum(axis=(1, 2))
+
+        # 1:1:3:1:1 finder-like patterns with four light modules on one side
+        span = count - 10
+        for pattern in FINDER_LIKE:
+            match = np.ones((grid.shape[0], count, span), dtype=bool)
+            for k, dark in enumerate(pattern):
+                cells = grid[:, :, k:k + span]
+                match &= cells if dark else ~cells
+            points += 40 * match.sum(axis=(1, 2))
+
+    # 2x2 blocks of one colour
+    top_left = modules[:, :-1, :-1]
+    block = ((top_left == modules[:, :-1, 1:]) & (top_left == modules[:, 1:, :-1])
+             & (top_left == modules[:, 1:, 1:]))
+    points += 3 * block.sum(axis=(1, 2))
+
+    # Every 5% departure from 50% dark
+    percent = modules.sum(axis=(1, 2)).astype(np.float64) / (count ** 2)
+    points += np.floor(np.abs(percent * 100 - 50) / 5).astype(np.int64) * 10
+    return points
+
+
+class _Layout:
+    """Everything about a (version, error correction) symbol that does not
+    depend on the payload, built with the qrcode library's own pattern code."""
+
+    def __init__(self, version, error_correction):
+        size = version * 4 + 17
+        qr = qrcode.QRCode(version=version, error_correction=error_correction, border=0)
+        qr.modules_count = size
+        qr.modules = [[None] * size for _ in range(size)]
+        qr.setup_position_probe_pattern(0, 0)
+        qr.setup_position_probe_pattern(size - 7, 0)
+        qr.setup_position_probe_pattern(0, size - 7)
+        qr.setup_position_adjust_pattern()
+        qr.setup_timing_pattern()
+
+        def snapshot():
+            return np.array([[bool(cell) for cell in row] for row in qr.modules])
+
+        # Mask scoring happens with format and version bits left light
+        qr.setup_type_info(True, 0)
+        if version >= 7:
+            qr.setup_type_number(True)
+        self.data_cells = np.array([[cell is None for cell in row] for row in qr.modules])
+        self.test_pattern = snapshot()
+        self.final_patterns = []
+        for mask in range(8):
+            qr.setup_type_info(False, mask)
+            if version >= 7:
+                qr.setup_type_number(False)
+            self.final_patterns.append(snapshot())
+
+        rows, cols = np.indices((size, size))
+        self.masks = np.array([
+            np.vectorize(util.mask_func(mask))(rows, cols).astype(bool) & self.data_cells
+            for mask in range(8)
+        ])
+
+        # Zig-zag placement order, as in QRCode.map_data
+        order = []
+        inc, row = -1, size - 1
+        for col in range(size - 1, 0, -2):
+            if col <= 6:
+                col -= 1
+            while True:
+                for c in (col, col - 1):
+                    if self.data_cells[row, c]:
+                        order.append((row, c))
+                row += inc
+                if row < 0 or size <= row:
+                    row -= inc
+                    inc = -inc
+                    break
+        self.cell_rows, self.cell_cols = np.array(order).T
+
+        self.blocks = base.rs_blocks(version, error_correction)
+        self.data_count = sum(block.data_count for block in self.blocks)
+        self.generators = {}
+        for block in self.blocks:
+            ec_count = block.total_count - block.data_count
+            if ec_count not in self.generators:
+                if ec_count in LUT.rsPoly_LUT:
+                    generator = base.Polynomial(LUT.rsPoly_LUT[ec_count], 0)
+                else:
+                    generator = base.Polynomial([1], 0)
+                    for i in range(ec_count):
+                        generator = generator * base.Polynomial([1, base.gexp(i)], 0)
+                self.generators[ec_count] = np.array(generator.num, dtype=np.int64)
+
+    def data_codewords(self, digits):
+        # Mode, length and digit groups, then terminator and padding as in
+        # util.create_data
+        batch, length = digits.shape
+        fields = [(np.full(batch, util.MODE_NUMBER), 4), (np.full(batch, length), 10)]
+        for i in range(0, length, 3):
+            group = digits[:, i:i + 3].astype(np.int64)
+            weights = 10 ** np.arange(group.shape[1] - 1, -1, -1)
+            fields.append((group @ weights, util.NUMBER_LENGTH[group.shape[1]]))
+        bits = np.concatenate([
+            (values[:, None] >> np.arange(width - 1, -1, -1)) & 1 for values, width in fields
+        ], axis=1).astype(np.uint8)
+
+        bit_limit = self.data_count * 8
+        terminator = min(bit_limit - bits.shape[1], 4)
+        padded = -(-(bits.shape[1] + terminator) // 8) * 8
+        bits = np.pad(bits, ((0, 0), (0, padded - bits.shape[1])))
+        codewords = np.packbits(bits, axis=1).astype(np.int64)
+        fill = self.data_count - codewords.shape[1]
+        pad_bytes = np.resize([util.PAD0, util.PAD1], fill)
+        return np.concatenate([codewords, np.broadcast_to(pad_bytes, (batch, fill))], axis=1)
+
+    def interleave(self, data):
+        # Error correction per block, then data/ec interleaving as in
+        # util.create_bytes
+        dcdata, ecdata = [], []
+        offset = 0
+        for block in self.blocks:
+            current = data[:, offset:offset + block.data_count]
+            offset += block.data_count
+            dcdata.append(current)
+            ecdata.append(_rs_remainder(current, self.generators[block.total_count - block.data_count]))
+        columns = []
+        for blocks in (dcdata, ecdata):
+            for i in range(max(b.shape[1] for b in blocks)):
+                columns.extend(b[:, i] for b in blocks if i < b.shape[1])
+        return np.stack(columns, axis=1).astype(np.uint8)
+
+    def encode(self, digits):
+        batch = digits.shape[0]
+        size = self.data_cells.shape[0]
+        bits = np.unpackbits(self.interleave(self.data_codewords(digits)), axis=1).astype(bool)
+        cell_count = len(self.cell_rows)
+        if bits.shape[1] < cell_count:
+            # Remainder bits are light before masking
+            bits = np.pad(bits, ((0, 0), (0, cell_count - bits.shape[1])))
+        data = np.zeros((batch, size, size), dtype=bool)
+        data[:, self.cell_rows, self.cell_cols] = bits[:, :cell_count]
+
+        candidates = (data[:, None] ^ self.masks[None]) | self.test_pattern
+        points = _lost_points(candidates.reshape(batch * 8, size, size)).reshape(batch, 8)
+        best = points.argmin(axis=1)
+
+        final = np.array(self.final_patterns)[best]
+        return (data ^ self.masks[best]) | final
+
+
+@lru_cache(maxsize=None)
+def _layout(version, error_correction):
+    # _Layout leans on qrcode internals, so each one is checked against the
+    # library on a sample payload before use; None sends that version back
+    # to the library if a qrcode release has changed underneath it
+    length = max(n for n in range(1, 1024) if _numeric_version(n, error_correction) == version)
+    sample = ('31415926535897932384' * 52)[:length]
+    try:
+        layout = _Layout(version, error_correction)
+        digits = (np.frombuffer(sample.encode('ascii'), dtype=np.uint8) - ord('0')).reshape(1, length)
+        matches = np.array_equal(layout.encode(digits)[0],
+                                 np.asarray(make_modules(sample, error_correction, 0), dtype=bool))
+    except Exception:
+        matches = False
+    if not matches:
+        logger.warning('Batch encoder disagrees with the qrcode library for version %d, '
+                       'error correction %d; encoding those payloads with the library',
+                       version, error_correction)
+        return None
+    return layout
+
+
+def encode_batch(values, error_correction=qrcode.constants.ERROR_CORRECT_L, border=2):
+    """Return one module matrix (border included) per value.
+
+    Pure-digit payloads are grouped by version and length and encoded
+    together with array operations; anything else goes through the qrcode
+    library. The matrices are identical to QRCode(version=1, ...).make(fit=True)
+    followed by get_matrix().
+    """
+    texts = [str(value) for value in values]
+    matrices = [None] * len(texts)
+    groups = {}
+    for i, text in enumerate(texts):
+        version = None
+        if text.isascii() and text.isdigit():
+            version = _numeric_version(len(text), error_correction)
+        if version is not None and _layout(version, error_correction) is not None:
+            groups.setdefault((version, len(text)), []).append(i)
+        else:
+            matrices[i] = np.asarray(make_modules(text, error_correction, border), dtype=bool)
+
+    for (version, length), indices in groups.items():
+        layout = _layout(version, error_correction)
+        for start in range(0, len(indices), CHUNK_SIZE):
+            chunk = indices[start:start + CHUNK_SIZE]
+            encoded = ''.join(texts[i] for i in chunk).encode('ascii')
+            digits = (np.frombuffer(encoded, dtype=np.uint8) - ord('0')).reshape(len(chunk), length)
+            for i, modules in zip(chunk, layout.encode(digits)):
+                matrices[i] = np.pad(modules, border) if border else modules
+    return matrices
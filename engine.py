@@ -0,0 +1,225 @@
+# engine.py
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import qrcode
+
+from encoder import encode_batch, make_modules
+from metrics import StageTimer
+from render import render_tile_png, tile_cache_key
+
+logger = logging.getLogger(__name__)
+
+def _pool_context():
+    # The pool is started from a request thread while job threads may be
+    # running, and forking a threaded process can leave locks held in the
+    # children. A fork server is started once, with this module already
+    # imported, and forks cleanly from there.
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+# The tiles /generate has always produced
+DEFAULT_STYLE = {'box_size': 6, 'border': 2,
+                 'error_correction': qrcode.constants.ERROR_CORRECT_L, 'label': True}
+
+
+def _render_payloads(payloads, style):
+    # Runs inside a pool worker. Errors are returned rather than raised so one
+    # bad row never takes down the rest of its batch. Each result carries the
+    # row's render time, and stage timings for the batch come back with them.
+    timer = StageTimer()
+    with timer.stage('qr_encode'):
+        try:
+            matrices = encode_batch(payloads, style['error_correction'], style['border'])
+        except Exception:
+            # Let each payload succeed or fail on its own below
+            matrices = [None] * len(payloads)
+    # Batch encoding is shared out evenly between the rows
+    encode_share = timer.seconds['qr_encode'] / len(payloads)
+    results = []
+    for tiffin_number, modules in zip(payloads, matrices):
+        start = time.perf_counter()
+        try:
+            if modules is None:
+                with timer.stage('qr_encode'):
+                    modules = make_modules(tiffin_number, style['error_correction'], style['border'])
+            png, error = render_tile_png(modules, tiffin_number, style['box_size'], timer,
+                                         style['label']), None
+        except Exception as qr_err:
+            png, error = None, repr(qr_err)
+        results.append((png, error, encode_share + time.perf_counter() - start))
+    return results, dict(timer.seconds)
+
+
+def _run_inline(fn, *args):
+    # Same shape as RenderEngine._pool_submit: (future, pool)
+    future = Future()
+    future.set_result(fn(*args))
+    return future, None
+
+
+class RenderEngine:
+    """Render QR tiles for many rows across a pool of worker processes.
+
+    Rows are (row_number, tiffin_number) pairs. Results come back in input
+    order as (row_number, tiffin_number, png_bytes, error) tuples, where
+    exactly one of png_bytes / error is None. With a cache, tiles rendered
+    before are served from it and only misses reach the pool, so repeated
+    numbers within one job are rendered once while the cache holds them.
+    Without one, repeats are only shared between batches still in flight.
+    """
+
+    def __init__(self, workers=None, batch_size=256, cache=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = max(1, batch_size)
+        self.cache = cache
+        self._pool = None
+        # Request threads and background jobs share one pool
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self):
+        # Created lazily and reused across requests; process start-up is far
+        # more expensive than a typical batch
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_pool_context())
+            return self._pool
+
+    def _discard_pool(self, pool):
+        # A worker died (killed for memory, or crashed in native code) and
+        # the executor refuses all further work. Drop it so the next caller
+        # builds a fresh one, unless another thread already has.
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _pool_submit(self, fn, *args):
+        pool = self._get_pool()
+        try:
+            return pool.submit(fn, *args), pool
+        except BrokenProcessPool:
+            self._discard_pool(pool)
+            pool = self._get_pool()
+            return pool.submit(fn, *args), pool
+
+    def _batches(self, rows):
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def render(self, rows, stats=None, style=None):
+        # stats, if given, is a metrics.RequestStats fed with stage timings
+        # and per-row latencies; style overrides entries of DEFAULT_STYLE
+        style = {**DEFAULT_STYLE, **(style or {})}
+        if stats is not None:
+            rows = stats.timed(rows, 'csv_parse')
+        batches = self._batches(rows)
+        first = next(batches, None)
+        if first is None:
+            return
+        second = next(batches, None)
+        if second is None or self.workers <= 1:
+            # Small jobs (or a single worker) are cheaper to render in-process
+            submit, max_pending = _run_inline, 1
+        else:
+            submit, max_pending = self._pool_submit, self.workers * 2
+        batches = itertools.chain([first], [second] if second else [], batches)
+
+        # Keep a bounded number of batches in flight so memory stays flat and
+        # results can be handed to the ZIP writer in order as they finish.
+        # in_flight maps a tile key to [rows still to yield, (png, error, seconds)].
+        pending = deque()
+        in_flight = {}
+        try:
+            for batch in batches:
+                pending.append(self._submit(submit, batch, in_flight, style))
+                if len(pending) >= max_pending:
+                    yield from self._collect(pending.popleft(), in_flight, stats, style)
+            while pending:
+                yield from self._collect(pending.popleft(), in_flight, stats, style)
+        finally:
+            # The client may have gone away mid-download
+            for submitted in pending:
+                if submitted[-1] is not None:
+                    submitted[-1].cancel()
+
+    def _submit(self, submit, batch, in_flight, style):
+        keys = []
+        lookup_seconds = []
+        to_render = []
+        for _, tiffin_number in batch:
+            key = tile_cache_key(tiffin_number, **style)
+            keys.append(key)
+            entry = in_flight.get(key)
+            start = time.perf_counter()
+            if entry is None:
+                cached = self.cache.get(key) if self.cache is not None else None
+                entry = in_flight[key] = [0, None if cached is None else (cached, None, 0.0)]
+                if cached is None:
+                    to_render.append((key, tiffin_number))
+            entry[0] += 1
+            lookup_seconds.append(time.perf_counter() - start)
+        future = pool = None
+        if to_render:
+            future, pool = submit(_render_payloads, [tiffin_number for _, tiffin_number in to_render], style)
+        return batch, keys, lookup_seconds, to_render, pool, future
+
+    def _collect(self, submitted, in_flight, stats, style):
+        batch, keys, lookup_seconds, to_render, pool, future = submitted
+        rendered = set()
+        if future is not None:
+            try:
+                results, stage_seconds = future.result()
+            except BrokenProcessPool:
+                results, stage_seconds = self._rerender(pool, [n for _, n in to_render], style)
+            if stats is not None:
+                stats.merge(stage_seconds)
+            for (key, _), (png, error, seconds) in zip(to_render, results):
+                in_flight[key][1] = (png, error, seconds)
+                rendered.add(key)
+                if png is not None and self.cache is not None:
+                    self.cache.put(key, png)
+        for (row_number, tiffin_number), key, lookup in zip(batch, keys, lookup_seconds):
+            entry = in_flight[key]
+            png, error, seconds = entry[1]
+            if stats is not None:
+                # Only the first row with a freshly rendered payload pays for it
+                stats.observe_row(lookup + (seconds if key in rendered else 0.0), error)
+                rendered.discard(key)
+            entry[0] -= 1
+            if not entry[0]:
+                del in_flight[key]
+            yield row_number, tiffin_number, png, error
+
+    def _rerender(self, broken_pool, payloads, style):
+        # The batch was in flight when its pool broke; it may not be the
+        # batch that broke it, so it gets one more try on a fresh pool. If
+        # that breaks too, its rows fail and later batches carry on.
+        self._discard_pool(broken_pool)
+        future, pool = self._pool_submit(_render_payloads, payloads, style)
+        try:
+            return future.result()
+        except BrokenProcessPool as e:
+            self._discard_pool(pool)
+            logger.warning('Render worker died twice on a batch of %d rows: %r', len(payloads), e)
+            return [(None, repr(e), 0.0)] * len(payloads), {}
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
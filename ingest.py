@@ -0,0 +1,88 @@
+# ingest.py
+import codecs
+import csv
+import io
+from functools import partial
+
+DEFAULT_COLUMNS = ('Tiffin Number',)
+# How far down the sheet to look for the header row
+HEADER_SEARCH_ROWS = 10
+# Excel's plain "CSV (Comma delimited)" export on Windows
+FALLBACK_ENCODING = 'cp1252'
+
+
+class IngestError(ValueError):
+    pass
+
+
+class _TextView(io.TextIOWrapper):
+    # Decoded view of the caller's binary stream. A TextIOWrapper closes the
+    # stream under it when closed or garbage collected; this one lets go.
+    def close(self):
+        try:
+            self.detach()
+        except ValueError:
+            pass
+
+
+def normalize_header(cell):
+    # "Tiffin \nnumber", " tiffin  NUMBER" and "Tiffin Number" all match
+    return ' '.join(cell.split()).casefold()
+
+
+def detect_encoding(stream):
+    # UTF-8 (with or without a BOM) if the whole stream decodes as UTF-8,
+    # otherwise the fallback; the stream is left where it started
+    start = stream.tell()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for chunk in iter(partial(stream.read, 64 * 1024), b''):
+            decoder.decode(chunk)
+        decoder.decode(b'', final=True)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING
+    finally:
+        stream.seek(start)
+
+
+def read_tiffin_rows(stream, columns=DEFAULT_COLUMNS, encoding=None):
+    """Read (row_number, tiffin_number) pairs from a binary CSV stream.
+
+    The header is located straight away, so a missing column is reported
+    before any rendering starts; the remaining rows are parsed lazily, one
+    line at a time, and a malformed line raises IngestError when it is
+    reached. columns lists accepted header names for the tiffin number
+    column. Rows with an empty tiffin cell (blank lines, the member
+    sub-header of the Thaali sheet) are skipped and not counted. Without an
+    encoding it is detected first, which needs a seekable stream.
+    """
+    if encoding is None:
+        encoding = detect_encoding(stream)
+    # newline='' lets the csv module handle \n, \r\n and old Mac \r endings
+    reader = csv.reader(_TextView(stream, encoding=encoding, newline=''))
+    wanted = {normalize_header(column) for column in columns}
+    try:
+        for _ in range(HEADER_SEARCH_ROWS):
+            header = next(reader, None)
+            if header is None:
+                break
+            for index, cell in enumerate(header):
+                if normalize_header(cell) in wanted:
+                    return _iter_values(reader, index)
+    except (csv.Error, UnicodeDecodeError) as e:
+        raise IngestError(f'Failed to read CSV file. Error: {str(e)}')
+    raise IngestError(f'CSV must have a header named "{columns[0]}".')
+
+
+def _iter_values(reader, index):
+    row_number = 0
+    try:
+        for cells in reader:
+            value = cells[index].strip() if index < len(cells) else ''
+            if not value:
+                continue
+            row_number += 1
+            yield row_number, value
+    except (csv.Error, UnicodeDecodeError) as e:
+        raise IngestError(f'Failed to read CSV file after row {row_number}. Error: {str(e)}')
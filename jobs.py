@@ -0,0 +1,176 @@
+# jobs.py
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import StageTimer, track_request
+from zipstream import stream_zip
+
+JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+ARCHIVE_NAME = 'qr_codes.zip'
+STATUS_NAME = 'status.json'
+UPLOAD_NAME = 'upload.csv'
+
+logger = logging.getLogger(__name__)
+
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+class JobManager:
+    """Background bulk jobs that outlive the request that queued them.
+
+    Each job gets a directory under jobs_dir holding status.json and, once
+    finished, the archive. Status lives on disk rather than in memory so any
+    gunicorn worker sharing jobs_dir can answer polls and downloads. A job
+    directory is removed once it has not been updated for ttl seconds, which
+    for a finished job means ttl seconds after it completed.
+
+    make_entries(rows, on_result, stats) must yield (name, bytes) archive
+    entries and call on_result(row_number, error) once per row, error being
+    None on success; stats is the job's metrics.RequestStats.
+    """
+
+    def __init__(self, jobs_dir, make_entries, workers=2, ttl=3600,
+                 compression=zipfile.ZIP_STORED, max_errors=1000):
+        self.jobs_dir = jobs_dir
+        self.make_entries = make_entries
+        self.ttl = ttl
+        self.compression = compression
+        self.max_errors = max_errors
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='qr-job')
+        self._last_purge = 0
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def _job_dir(self, job_id):
+        if not JOB_ID_RE.match(job_id or ''):
+            return None
+        return os.path.join(self.jobs_dir, job_id)
+
+    def _write_status(self, job_id, status):
+        status['updated_at'] = time.time()
+        status['expires_at'] = status['updated_at'] + self.ttl
+        path = os.path.join(self._job_dir(job_id), STATUS_NAME)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(status, f)
+        os.replace(tmp_path, path)
+
+    def submit(self, upload, read_rows):
+        # upload is a binary file copied into the job directory;
+        # read_rows(binary file) yields (row_number, tiffin_number) pairs
+        self.purge_expired()
+        job_id = uuid.uuid4().hex
+        os.makedirs(self._job_dir(job_id))
+        with open(os.path.join(self._job_dir(job_id), UPLOAD_NAME), 'wb') as f:
+            shutil.copyfileobj(upload, f)
+        status = {'job_id': job_id, 'state': 'queued', 'rows_done': 0, 'rows_total': None,
+                  'error_count': 0, 'errors': [], 'created_at': time.time(), 'pid': os.getpid()}
+        self._write_status(job_id, status)
+        self._executor.submit(self._run, job_id, read_rows, status)
+        return job_id
+
+    def _run(self, job_id, read_rows, status):
+        last_write = time.monotonic()
+
+        def on_result(row_number, error):
+            nonlocal last_write
+            status['rows_done'] += 1
+            if error is not None:
+                status['error_count'] += 1
+                if len(status['errors']) < self.max_errors:
+                    status['errors'].append({'row': row_number, 'error': str(error)})
+            # Progress only needs to be roughly current for pollers
+            if time.monotonic() - last_write > 0.5:
+                self._write_status(job_id, status)
+                last_write = time.monotonic()
+
+        upload = os.path.join(self._job_dir(job_id), UPLOAD_NAME)
+        archive = os.path.join(self._job_dir(job_id), ARCHIVE_NAME)
+        try:
+            status['state'] = 'running'
+            self._write_status(job_id, status)
+            # A parse-only pass is cheap next to rendering and gives pollers a total
+            count_timer = StageTimer()
+            with open(upload, 'rb') as f, count_timer.stage('csv_parse'):
+                status['rows_total'] = sum(1 for _ in read_rows(f))
+            self._write_status(job_id, status)
+            with (open(upload, 'rb') as f, open(f'{archive}.part', 'wb') as out,
+                  track_request('job') as stats):
+                stats.merge(count_timer.seconds)
+                entries = self.make_entries(read_rows(f), on_result, stats)
+                for chunk in stream_zip(entries, self.compression, stats):
+                    stats.bytes += len(chunk)
+                    out.write(chunk)
+            os.replace(f'{archive}.part', archive)
+            status['state'] = 'done'
+            status['archive_bytes'] = os.path.getsize(archive)
+        except Exception as e:
+            logger.exception('Job %s failed', job_id)
+            status['state'] = 'failed'
+            status['failure'] = str(e)
+        status['finished_at'] = time.time()
+        try:
+            self._write_status(job_id, status)
+        except OSError:
+            logger.exception('Could not record the outcome of job %s', job_id)
+
+    def status(self, job_id):
+        self.purge_expired()
+        job_dir = self._job_dir(job_id)
+        if job_dir is None:
+            return None
+        try:
+            with open(os.path.join(job_dir, STATUS_NAME)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def archive_path(self, job_id):
+        status = self.status(job_id)
+        if status is None or status['state'] != 'done':
+            return None
+        return os.path.join(self._job_dir(job_id), ARCHIVE_NAME)
+
+    def purge_expired(self):
+        # Cheap enough to run from request handlers, but no more than once a minute
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        for job_id in os.listdir(self.jobs_dir):
+            job_dir = self._job_dir(job_id)
+            if job_dir is None:
+                continue
+            try:
+                with open(os.path.join(job_dir, STATUS_NAME)) as f:
+                    status = json.load(f)
+                expires_at = status['expires_at']
+                # Queued jobs can wait longer than ttl behind others; keep
+                # unfinished jobs while the process that owns them is alive
+                if status['state'] in ('queued', 'running') and _pid_alive(status.get('pid')):
+                    continue
+            except (OSError, ValueError, KeyError):
+                # No readable status; fall back to the directory's own age
+                try:
+                    expires_at = os.path.getmtime(job_dir) + self.ttl
+                except OSError:
+                    continue
+            if expires_at < now:
+                shutil.rmtree(job_dir, ignore_errors=True)
@@ -0,0 +1,330 @@
+# metrics.py
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+STAGES = ('csv_parse', 'qr_encode', 'rasterize', 'label_draw', 'png_encode', 'zip_write')
+
+logger = logging.getLogger(__name__)
+
+# Prometheus buckets for per-row latency, in seconds
+ROW_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Finer geometric buckets (10us to ~60s, 20% apart) for per-request
+# percentiles; a quantile is reported as its bucket's upper bound
+_QUANTILE_BOUNDS = [10e-6 * 1.2 ** k for k in range(86)]
+
+
+class StageTimer:
+    """Accumulates wall time per pipeline stage."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+
+    def merge(self, seconds):
+        for name, value in seconds.items():
+            self.seconds[name] += value
+
+    def timed(self, iterable, name):
+        # Charges the time spent producing each item to the stage
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.seconds[name] += time.perf_counter() - start
+                return
+            self.seconds[name] += time.perf_counter() - start
+            yield item
+
+
+class _NullTimer:
+    def stage(self, name):
+        return nullcontext()
+
+
+NULL_TIMER = _NullTimer()
+
+
+class RequestStats(StageTimer):
+    """Counters for one /generate request or background job."""
+
+    def __init__(self, output):
+        super().__init__()
+        self.output = output
+        self.started = time.perf_counter()
+        self.rows = 0
+        self.failures = 0
+        self.bytes = 0
+        self._latency_counts = [0] * (len(_QUANTILE_BOUNDS) + 1)
+        self.row_seconds = []
+
+    def observe_row(self, seconds, error):
+        self.rows += 1
+        if error is not None:
+            self.failures += 1
+        self._latency_counts[bisect.bisect_left(_QUANTILE_BOUNDS, seconds)] += 1
+        # Kept for the shared registry, which drains it at the end
+        self.row_seconds.append(seconds)
+        if len(self.row_seconds) >= 4096:
+            registry.observe_rows(self.row_seconds)
+            self.row_seconds = []
+
+    def quantile(self, q):
+        if not self.rows:
+            return 0.0
+        target = q * self.rows
+        seen = 0
+        for index, count in enumerate(self._latency_counts):
+            seen += count
+            if seen >= target:
+                return _QUANTILE_BOUNDS[min(index, len(_QUANTILE_BOUNDS) - 1)]
+        return _QUANTILE_BOUNDS[-1]
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            'event': 'qr_generate',
+            'output': self.output,
+            'rows': self.rows,
+            'failures': self.failures,
+            'bytes': self.bytes,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(self.rows / elapsed, 1) if elapsed else None,
+            'row_latency_p50_ms': round(self.quantile(0.5) * 1000, 3),
+            'row_latency_p99_ms': round(self.quantile(0.99) * 1000, 3),
+            'stage_seconds': {name: round(self.seconds.get(name, 0.0), 4) for name in STAGES},
+        }
+
+
+# Cache counters summed over every process that ever wrote a snapshot, and
+# gauges summed over the processes still running
+CACHE_COUNTERS = ('memory_hits', 'disk_hits', 'misses', 'memory_evictions', 'disk_evictions')
+CACHE_GAUGES = ('memory_bytes',)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+class Registry:
+    """Service-wide totals, rendered in the Prometheus text format.
+
+    Every process counts into its own registry. gunicorn workers share one
+    listening socket, so a scrape reaches an arbitrary worker; after share()
+    each process also writes its totals to a file in a shared directory and
+    render() sums them all. Files of exited workers are kept, so counters
+    never go backwards while the directory lives.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.rows = 0
+        self.failures = 0
+        self.bytes = 0
+        self.stage_seconds = defaultdict(float)
+        self.bucket_counts = [0] * len(ROW_BUCKETS)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.directory = None
+        self._path = None
+        self.cache_stats = None
+        self._last_save = 0.0
+
+    def share(self, directory, cache_stats=None):
+        # cache_stats, if given, returns this process's RenderCache.stats()
+        # and is published along with the request counters
+        self.cache_stats = cache_stats
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        # Unique per process, so a recycled pid never overwrites a dead
+        # worker's counters
+        self._path = os.path.join(directory, f'{os.getpid()}-{uuid.uuid4().hex}.json')
+
+    def observe_rows(self, row_seconds):
+        with self._lock:
+            for seconds in row_seconds:
+                index = bisect.bisect_left(ROW_BUCKETS, seconds)
+                if index < len(ROW_BUCKETS):
+                    self.bucket_counts[index] += 1
+                self.latency_sum += seconds
+            self.latency_count += len(row_seconds)
+
+    def record(self, stats):
+        self.observe_rows(stats.row_seconds)
+        stats.row_seconds = []
+        with self._lock:
+            self.requests[stats.output] += 1
+            self.rows += stats.rows
+            self.failures += stats.failures
+            self.bytes += stats.bytes
+            for name, seconds in stats.seconds.items():
+                self.stage_seconds[name] += seconds
+        self.save()
+
+    def snapshot(self):
+        cache = self.cache_stats() if self.cache_stats is not None else {}
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'requests': dict(self.requests),
+                'rows': self.rows,
+                'failures': self.failures,
+                'bytes': self.bytes,
+                'stage_seconds': dict(self.stage_seconds),
+                'bucket_counts': list(self.bucket_counts),
+                'latency_sum': self.latency_sum,
+                'latency_count': self.latency_count,
+                'cache': cache,
+            }
+
+    def save(self, every=0.0):
+        # Publishes this process's totals; every throttles calls made on
+        # each request. Without share() there is nothing to write.
+        if self.directory is None or time.monotonic() - self._last_save < every:
+            return
+        self._last_save = time.monotonic()
+        tmp_path = f'{self._path}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, self._path)
+        except OSError:
+            logger.warning('Could not write metrics to %s', self.directory, exc_info=True)
+
+    def totals(self):
+        # This process's snapshot, summed with every other process's file
+        own = self.snapshot()
+        if self.directory is None:
+            return own
+        self.save()
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        total = {
+            'requests': defaultdict(int), 'rows': 0, 'failures': 0, 'bytes': 0,
+            'stage_seconds': defaultdict(float), 'bucket_counts': [0] * len(ROW_BUCKETS),
+            'latency_sum': 0.0, 'latency_count': 0, 'cache': dict(own['cache']),
+        }
+        for name in CACHE_COUNTERS + CACHE_GAUGES:
+            if name in total['cache']:
+                total['cache'][name] = 0
+        for snapshot in snapshots:
+            for output, count in snapshot['requests'].items():
+                total['requests'][output] += count
+            for name in ('rows', 'failures', 'bytes', 'latency_sum', 'latency_count'):
+                total[name] += snapshot[name]
+            for name, seconds in snapshot['stage_seconds'].items():
+                total['stage_seconds'][name] += seconds
+            for index, count in enumerate(snapshot['bucket_counts']):
+                total['bucket_counts'][index] += count
+            alive = snapshot['pid'] == own['pid'] or _pid_alive(snapshot['pid'])
+            for name in CACHE_COUNTERS + (CACHE_GAUGES if alive else ()):
+                if name in total['cache']:
+                    total['cache'][name] += snapshot['cache'].get(name, 0)
+        return total
+
+    def render(self):
+        # The disk tier's size is shared already, so it is reported as is
+        total = self.totals()
+        lines = [
+            '# HELP qr_requests_total Bulk generation requests and jobs, by output format.',
+            '# TYPE qr_requests_total counter',
+        ]
+        lines += [f'qr_requests_total{{output="{output}"}} {count}'
+                  for output, count in sorted(total['requests'].items())]
+        lines += [
+            '# HELP qr_rows_total Rows processed.',
+            '# TYPE qr_rows_total counter',
+            f'qr_rows_total {total["rows"]}',
+            '# HELP qr_row_failures_total Rows that failed to render and were skipped.',
+            '# TYPE qr_row_failures_total counter',
+            f'qr_row_failures_total {total["failures"]}',
+            '# HELP qr_output_bytes_total Bytes of archives and sheets produced.',
+            '# TYPE qr_output_bytes_total counter',
+            f'qr_output_bytes_total {total["bytes"]}',
+            '# HELP qr_stage_seconds_total Time spent per pipeline stage, summed over render processes.',
+            '# TYPE qr_stage_seconds_total counter',
+        ]
+        lines += [f'qr_stage_seconds_total{{stage="{name}"}} {total["stage_seconds"].get(name, 0.0):.6f}'
+                  for name in STAGES]
+        lines += [
+            '# HELP qr_row_seconds Render latency per row, cache hits included.',
+            '# TYPE qr_row_seconds histogram',
+        ]
+        cumulative = 0
+        for bound, count in zip(ROW_BUCKETS, total['bucket_counts']):
+            cumulative += count
+            lines.append(f'qr_row_seconds_bucket{{le="{bound}"}} {cumulative}')
+        lines += [
+            f'qr_row_seconds_bucket{{le="+Inf"}} {total["latency_count"]}',
+            f'qr_row_seconds_sum {total["latency_sum"]:.6f}',
+            f'qr_row_seconds_count {total["latency_count"]}',
+        ]
+        cache_stats = total['cache']
+        if cache_stats:
+            lines += [
+                '# HELP qr_cache_hits_total Tile cache hits, by tier.',
+                '# TYPE qr_cache_hits_total counter',
+                f'qr_cache_hits_total{{tier="memory"}} {cache_stats["memory_hits"]}',
+                f'qr_cache_hits_total{{tier="disk"}} {cache_stats["disk_hits"]}',
+                '# HELP qr_cache_misses_total Tile cache misses.',
+                '# TYPE qr_cache_misses_total counter',
+                f'qr_cache_misses_total {cache_stats["misses"]}',
+                '# HELP qr_cache_evictions_total Tile cache evictions, by tier.',
+                '# TYPE qr_cache_evictions_total counter',
+                f'qr_cache_evictions_total{{tier="memory"}} {cache_stats["memory_evictions"]}',
+                f'qr_cache_evictions_total{{tier="disk"}} {cache_stats["disk_evictions"]}',
+                '# HELP qr_cache_bytes Bytes currently held by the tile cache, by tier.',
+                '# TYPE qr_cache_bytes gauge',
+                f'qr_cache_bytes{{tier="memory"}} {cache_stats["memory_bytes"]}',
+            ]
+            if 'disk_bytes' in cache_stats:
+                lines.append(f'qr_cache_bytes{{tier="disk"}} {cache_stats["disk_bytes"]}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+@contextmanager
+def track_request(output):
+    # Records the request into the registry and logs a one-line JSON summary
+    # when it ends, including when the client disconnects early. The summary
+    # dict is also attached to the record as "summary" for structured handlers.
+    stats = RequestStats(output)
+    try:
+        yield stats
+    finally:
+        registry.record(stats)
+        summary = stats.summary()
+        logger.log(logging.WARNING if stats.failures else logging.INFO,
+                   json.dumps(summary), extra={'summary': summary})
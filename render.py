@@ -0,0 +1,215 @@
+# render.py
+import io
+from xml.sax.saxutils import escape
+
+import numpy as np
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+
+from cache import cache_key
+from encoder import encode_batch
+from metrics import NULL_TIMER
+
+LABEL_PREFIX = "Tiffin #: "
+LABEL_HEIGHT = 50
+LABEL_TOP = 10
+FONT_NAME = "arial.ttf"
+FONT_SIZE = 22
+# Bump whenever rendering changes the output for the same inputs; it is part
+# of every cache key and ETag
+RENDER_VERSION = 1
+
+# Characters that get a pre-rendered glyph; anything else falls back to draw.text
+GLYPHS = "0123456789"
+
+
+def load_font():
+    try:
+        return ImageFont.truetype(FONT_NAME, FONT_SIZE)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def _blit(canvas, piece, x, y):
+    # Darkest pixel wins, which is how FreeType coverage of overlapping
+    # glyphs combines when black ink is drawn on a white background
+    height, width = piece.shape
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + width, canvas.shape[1]), min(y + height, canvas.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+    region = canvas[y0:y1, x0:x1]
+    np.minimum(region, piece[y0 - y:y1 - y, x0 - x:x1 - x], out=region)
+
+
+class LabelRenderer:
+    """Draws "Tiffin #: <number>" labels by compositing pre-rendered glyphs.
+
+    The prefix and each digit are rendered once with Pillow, then pasted at
+    the pen positions Pillow itself would use. On construction the result is
+    checked against ImageDraw.text for every digit pair; if the font's
+    kerning or sub-pixel advances make compositing inexact, every label is
+    drawn with ImageDraw.text instead.
+    """
+
+    def __init__(self, font):
+        self.font = font
+        self.fast = False
+        if not isinstance(font, ImageFont.FreeTypeFont):
+            return
+        self._prefix = self._render_piece(LABEL_PREFIX)
+        self._glyphs = {ch: self._render_piece(ch) for ch in GLYPHS}
+        # Pen offset of the first digit, and the advance of each digit when
+        # followed by another, both with kerning applied
+        self._first_pen = {b: font.getlength(LABEL_PREFIX + b) - font.getlength(b) for b in GLYPHS}
+        self._advances = {(a, b): font.getlength(a + b) - font.getlength(b)
+                          for a in GLYPHS for b in GLYPHS}
+        self.fast = self._validate()
+
+    def _render_piece(self, text):
+        left, top, right, bottom = self.font.getbbox(text, mode="L")
+        piece = Image.new("L", (max(right - left, 1), max(bottom - top, 1)), 255)
+        ImageDraw.Draw(piece).text((-left, -top), text, fill=0, font=self.font)
+        return np.asarray(piece), left, top
+
+    def _validate(self):
+        pens = list(self._first_pen.values()) + list(self._advances.values())
+        if not all(float(pen).is_integer() for pen in pens):
+            return False
+        probes = [a + b for a in GLYPHS for b in GLYPHS] + [GLYPHS, GLYPHS[::-1], "1111111"]
+        for digits in probes:
+            text = LABEL_PREFIX + digits
+            left, top, right, bottom = self.font.getbbox(text, mode="L")
+            size = (right - left + 40, bottom + 20)
+            reference = Image.new("L", size, 255)
+            ImageDraw.Draw(reference).text((20, 10), text, fill=0, font=self.font)
+            composed = np.full((size[1], size[0]), 255, dtype=np.uint8)
+            self._composite(composed, digits, 20, 10)
+            if not np.array_equal(np.asarray(reference), composed):
+                return False
+        return True
+
+    def _composite(self, canvas, digits, x, y):
+        piece, left, top = self._prefix
+        _blit(canvas, piece, x + left, y + top)
+        pen = x + int(self._first_pen[digits[0]])
+        for k, ch in enumerate(digits):
+            if k:
+                pen += int(self._advances[digits[k - 1], ch])
+            piece, left, top = self._glyphs[ch]
+            _blit(canvas, piece, pen + left, y + top)
+
+    def draw(self, canvas, text, y):
+        # Centred horizontally on the canvas, as ImageDraw.textbbox/text would
+        left, _, right, _ = self.font.getbbox(text, mode="L")
+        x = (canvas.shape[1] - (right - left)) // 2
+        digits = text[len(LABEL_PREFIX):]
+        if (self.fast and text.startswith(LABEL_PREFIX) and digits
+                and all(ch in self._glyphs for ch in digits)):
+            self._composite(canvas, digits, x, y)
+            return canvas
+        img = Image.fromarray(canvas)
+        ImageDraw.Draw(img).text((x, y), text, fill="black", font=self.font)
+        return np.array(img)
+
+
+_label_renderer = None
+
+
+def get_label_renderer():
+    # One font load and glyph strip per process
+    global _label_renderer
+    if _label_renderer is None:
+        _label_renderer = LabelRenderer(load_font())
+    return _label_renderer
+
+
+def rasterize(modules, box_size):
+    # Scale the module matrix (border included) straight to pixels
+    dark = np.asarray(modules, dtype=bool)
+    pixels = np.where(dark, np.uint8(0), np.uint8(255))
+    return pixels.repeat(box_size, axis=0).repeat(box_size, axis=1)
+
+
+def compose_tile(modules, label_text, box_size, timer=NULL_TIMER):
+    # label_text=None leaves out the label strip entirely
+    with timer.stage('rasterize'):
+        qr_pixels = rasterize(modules, box_size)
+        if label_text is None:
+            return qr_pixels
+        qr_height, width = qr_pixels.shape
+        tile = np.full((qr_height + LABEL_HEIGHT, width), 255, dtype=np.uint8)
+        tile[:qr_height] = qr_pixels
+    with timer.stage('label_draw'):
+        return get_label_renderer().draw(tile, label_text, qr_height + LABEL_TOP)
+
+
+def encode_png(tile):
+    # Tiles are greyscale, so a palette of only the levels in use is exact;
+    # a pure black/white tile is written as 1-bit
+    counts = np.bincount(tile.ravel(), minlength=256)
+    levels = np.flatnonzero(counts)
+    if set(levels.tolist()) <= {0, 255}:
+        img = Image.fromarray(tile > 127)
+    else:
+        lookup = np.zeros(256, dtype=np.uint8)
+        lookup[levels] = np.arange(len(levels), dtype=np.uint8)
+        img = Image.fromarray(lookup[tile])
+        img.putpalette(np.repeat(levels, 3).astype(np.uint8).tobytes())
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format='PNG')
+    return img_byte_arr.getvalue()
+
+
+def label_for(tiffin_number, label=True):
+    return f"{LABEL_PREFIX}{tiffin_number}" if label else None
+
+
+def render_tile_png(modules, tiffin_number, box_size=6, timer=NULL_TIMER, label=True):
+    tile = compose_tile(modules, label_for(tiffin_number, label), box_size, timer)
+    with timer.stage('png_encode'):
+        return encode_png(tile)
+
+
+def render_tile_svg(modules, tiffin_number, box_size=6, label=True):
+    # One path for all dark modules, a horizontal run per subpath; the label
+    # is live text, so it will not match the PNG glyph for glyph
+    dark = np.asarray(modules, dtype=bool)
+    rows, cols = dark.shape
+    width, qr_height = cols * box_size, rows * box_size
+    label_text = label_for(tiffin_number, label)
+    height = qr_height + (LABEL_HEIGHT if label_text is not None else 0)
+    runs = []
+    for y, row in enumerate(dark):
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], row.view(np.int8), [0]))))
+        for x0, x1 in zip(edges[::2], edges[1::2]):
+            length = (x1 - x0) * box_size
+            runs.append(f'M{x0 * box_size},{y * box_size}h{length}v{box_size}h-{length}z')
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'viewBox="0 0 {width} {height}" shape-rendering="crispEdges">',
+        '<rect width="100%" height="100%" fill="#fff"/>',
+        f'<path fill="#000" d="{"".join(runs)}"/>',
+    ]
+    if label_text is not None:
+        parts.append(
+            f'<text x="{width / 2:g}" y="{qr_height + LABEL_TOP}" font-family="Arial, sans-serif" '
+            f'font-size="{FONT_SIZE}" text-anchor="middle" dominant-baseline="hanging">'
+            f'{escape(label_text)}</text>')
+    parts.append('</svg>')
+    return ''.join(parts).encode('utf-8')
+
+
+def render_qr_png(tiffin_number, box_size=6, border=2,
+                  error_correction=qrcode.constants.ERROR_CORRECT_L, label=True):
+    # QR only encodes the tiffin number
+    modules = encode_batch([tiffin_number], error_correction, border)[0]
+    return render_tile_png(modules, tiffin_number, box_size, label=label)
+
+
+def tile_cache_key(tiffin_number, box_size=6, border=2,
+                   error_correction=qrcode.constants.ERROR_CORRECT_L, label=True,
+                   image_format='png'):
+    # Also used as the HTTP ETag, so it must change whenever the output does
+    return cache_key(RENDER_VERSION, image_format, str(tiffin_number), error_correction,
+                     box_size, border, label_for(tiffin_number, label), FONT_NAME, FONT_SIZE)
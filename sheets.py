@@ -0,0 +1,152 @@
+# sheets.py
+import io
+import math
+import zlib
+
+import numpy as np
+from PIL import Image
+
+PAGE_SIZES_MM = {
+    'A4': (210, 297),
+    'A5': (148, 210),
+    'Letter': (215.9, 279.4),
+}
+
+
+def _mm_to_px(mm, dpi):
+    return int(round(mm / 25.4 * dpi))
+
+
+class SheetLayout:
+    """An N x M grid of equal cells on a printable page, in pixels at dpi."""
+
+    def __init__(self, page_size='A4', columns=4, rows=6, dpi=300, margin_mm=10, gutter_mm=4):
+        if page_size not in PAGE_SIZES_MM:
+            raise ValueError(f'Unknown page size "{page_size}". Use one of: {", ".join(PAGE_SIZES_MM)}.')
+        if columns < 1 or rows < 1:
+            raise ValueError('A sheet needs at least one column and one row.')
+        if not 72 <= dpi <= 600:
+            raise ValueError('dpi must be between 72 and 600.')
+        for name, value in (('margin_mm', margin_mm), ('gutter_mm', gutter_mm)):
+            if not math.isfinite(value) or value < 0:
+                raise ValueError(f'{name} must be a number of millimetres, zero or more.')
+        width_mm, height_mm = PAGE_SIZES_MM[page_size]
+        self.columns = columns
+        self.rows = rows
+        self.dpi = dpi
+        self.width = _mm_to_px(width_mm, dpi)
+        self.height = _mm_to_px(height_mm, dpi)
+        self.margin = _mm_to_px(margin_mm, dpi)
+        self.gutter = _mm_to_px(gutter_mm, dpi)
+        self.cell_width = (self.width - 2 * self.margin - (columns - 1) * self.gutter) // columns
+        self.cell_height = (self.height - 2 * self.margin - (rows - 1) * self.gutter) // rows
+        if self.cell_width < 1 or self.cell_height < 1:
+            raise ValueError('Margins and gutters leave no room for labels on the page.')
+
+    @property
+    def per_page(self):
+        return self.columns * self.rows
+
+    def cell_origin(self, slot):
+        row, column = divmod(slot, self.columns)
+        return (self.margin + column * (self.cell_width + self.gutter),
+                self.margin + row * (self.cell_height + self.gutter))
+
+
+def _fit_tile(tile, layout):
+    # Whole-number nearest-neighbour scaling keeps module edges crisp; tiles
+    # larger than a cell are shrunk to fit
+    height, width = tile.shape
+    scale = min(layout.cell_width // width, layout.cell_height // height)
+    if scale >= 1:
+        return tile.repeat(scale, axis=0).repeat(scale, axis=1) if scale > 1 else tile
+    ratio = min(layout.cell_width / width, layout.cell_height / height)
+    size = (max(1, int(width * ratio)), max(1, int(height * ratio)))
+    return np.asarray(Image.fromarray(tile).resize(size, Image.LANCZOS))
+
+
+def iter_pages(tiles, layout):
+    """Paste PNG tiles into page canvases, yielding each page once it is full.
+
+    Every tile is decoded once and copied into its cell; only one page is
+    held in memory at a time.
+    """
+    page = None
+    slot = 0
+    for png in tiles:
+        if page is None:
+            page = np.full((layout.height, layout.width), 255, dtype=np.uint8)
+        tile = _fit_tile(np.asarray(Image.open(io.BytesIO(png)).convert('L')), layout)
+        x, y = layout.cell_origin(slot)
+        x += (layout.cell_width - tile.shape[1]) // 2
+        y += (layout.cell_height - tile.shape[0]) // 2
+        page[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+        slot += 1
+        if slot == layout.per_page:
+            yield page
+            page, slot = None, 0
+    if page is not None:
+        yield page
+
+
+def iter_page_pngs(pages, layout):
+    # (name, bytes) entries for stream_zip
+    for number, page in enumerate(pages, start=1):
+        img_byte_arr = io.BytesIO()
+        Image.fromarray(page).save(img_byte_arr, format='PNG', dpi=(layout.dpi, layout.dpi))
+        yield f'page_{number}.png', img_byte_arr.getvalue()
+
+
+def stream_pdf(pages, layout):
+    """Yield a PDF with one greyscale image per page, page by page.
+
+    Byte offsets are tracked as chunks go out so the cross-reference table
+    can be written at the end; the page tree (object 2) is written last,
+    once the page count is known.
+    """
+    offsets = {}
+    position = 0
+    kids = []
+
+    def emit(number, body, stream=None):
+        nonlocal position
+        offsets[number] = position
+        chunk = f'{number} 0 obj\n'.encode('ascii') + body
+        if stream is not None:
+            chunk += b'\nstream\n' + stream + b'\nendstream'
+        chunk += b'\nendobj\n'
+        position += len(chunk)
+        return chunk
+
+    header = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+    position = len(header)
+    yield header
+    yield emit(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+
+    # Page size in points, so the page prints at its physical size
+    width_pt = layout.width * 72 / layout.dpi
+    height_pt = layout.height * 72 / layout.dpi
+    number = 3
+    for page in pages:
+        image, contents, page_object = number, number + 1, number + 2
+        number += 3
+        data = zlib.compress(page.tobytes(), 6)
+        yield emit(image, (
+            f'<< /Type /XObject /Subtype /Image /Width {page.shape[1]} /Height {page.shape[0]}'
+            f' /ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /FlateDecode'
+            f' /Length {len(data)} >>').encode('ascii'), data)
+        draw = f'q {width_pt:.2f} 0 0 {height_pt:.2f} 0 0 cm /Im0 Do Q'.encode('ascii')
+        yield emit(contents, f'<< /Length {len(draw)} >>'.encode('ascii'), draw)
+        yield emit(page_object, (
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width_pt:.2f} {height_pt:.2f}]'
+            f' /Resources << /XObject << /Im0 {image} 0 R >> >> /Contents {contents} 0 R >>'
+        ).encode('ascii'))
+        kids.append(page_object)
+
+    refs = ' '.join(f'{kid} 0 R' for kid in kids)
+    yield emit(2, f'<< /Type /Pages /Kids [{refs}] /Count {len(kids)} >>'.encode('ascii'))
+
+    xref = [f'xref\n0 {number}\n', '0000000000 65535 f \n']
+    xref += [f'{offsets[n]:010d} 00000 n \n' for n in range(1, number)]
+    xref.append(f'trailer\n<< /Size {number} /Root 1 0 R >>\nstartxref\n{position}\n%%EOF\n')
+    yield ''.join(xref).encode('ascii')
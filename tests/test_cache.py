@@ -0,0 +1,123 @@
+# tests/test_cache.py
+import os
+
+import pytest
+
+import engine
+from cache import DISK_TOTAL_NAME, RenderCache, cache_key
+from engine import RenderEngine
+
+ENTRY = 1000
+
+
+def key(n):
+    return cache_key('test', n)
+
+
+def disk_files(directory):
+    return {name[:-4] for _, _, names in os.walk(directory) for name in names if name.endswith('.png')}
+
+
+def disk_bytes(directory):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(directory) for name in names if name.endswith('.png'))
+
+
+def set_age(cache, n, seconds_ago):
+    path = cache._disk_path(key(n))
+    mtime = os.path.getmtime(path) - seconds_ago
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def shared(tmp_path):
+    # Two workers' caches on one directory, with no memory tier so every get
+    # reaches the disk
+    return [RenderCache(memory_bytes=0, disk_dir=str(tmp_path), disk_bytes=10 * ENTRY) for _ in range(2)]
+
+
+def test_cap_holds_across_instances(shared, tmp_path):
+    for n in range(60):
+        shared[n % 2].put(key(n), b'x' * ENTRY)
+        assert disk_bytes(tmp_path) <= 10 * ENTRY
+    with open(os.path.join(tmp_path, DISK_TOTAL_NAME)) as f:
+        assert int(f.read()) == disk_bytes(tmp_path)
+    for cache in shared:
+        assert cache.stats()['disk_bytes'] == disk_bytes(tmp_path)
+    # 60 written, between 9 and 10 kept
+    evictions = sum(cache.stats()['disk_evictions'] for cache in shared)
+    assert evictions == 60 - len(disk_files(tmp_path))
+
+
+def test_least_recently_used_files_go_first(shared, tmp_path):
+    first, second = shared
+    for n in range(10):
+        first.put(key(n), b'x' * ENTRY)
+        set_age(first, n, 100 - n)
+    # A read through the other instance makes entry 0 the most recent
+    assert second.get(key(0)) == b'x' * ENTRY
+    second.put(key(10), b'x' * ENTRY)
+    kept = disk_files(tmp_path)
+    # Trimmed to 90% of the cap: the two oldest unread entries are gone
+    assert key(0) in kept and key(10) in kept
+    assert key(1) not in kept and key(2) not in kept
+    assert len(kept) == 9
+
+
+def test_counters_add_up(tmp_path):
+    cache = RenderCache(memory_bytes=3 * ENTRY, disk_dir=str(tmp_path), disk_bytes=100 * ENTRY)
+    for n in range(5):
+        cache.put(key(n), b'x' * ENTRY)
+    gets = [cache.get(key(n)) for n in (4, 3, 0, 1, 9)]
+    assert gets[-1] is None
+    stats = cache.stats()
+    # 3, 4 still in memory; 0 and 1 read back from disk; 9 nowhere
+    assert (stats['memory_hits'], stats['disk_hits'], stats['misses']) == (2, 2, 1)
+    assert stats['memory_hits'] + stats['disk_hits'] + stats['misses'] == len(gets)
+    assert stats['memory_entries'] == 3 and stats['memory_bytes'] == 3 * ENTRY
+    assert stats['memory_evictions'] == 5 + 2 - 3
+    assert stats['disk_bytes'] == 5 * ENTRY and stats['disk_evictions'] == 0
+
+
+def test_total_survives_restart(shared, tmp_path):
+    for n in range(4):
+        shared[0].put(key(n), b'x' * ENTRY)
+    assert RenderCache(disk_dir=str(tmp_path)).stats()['disk_bytes'] == 4 * ENTRY
+
+
+@pytest.fixture
+def render_calls(monkeypatch):
+    # Payloads that reach the renderer; workers=1 renders inline, in this process
+    calls = []
+    render_tile_png = engine.render_tile_png
+    monkeypatch.setattr(engine, 'render_tile_png',
+                        lambda modules, tiffin_number, *args: calls.append(tiffin_number)
+                        or render_tile_png(modules, tiffin_number, *args))
+    return calls
+
+
+def check_results(results, rows):
+    assert [(row, number) for row, number, _, _ in results] == rows
+    pngs = {number: png for _, number, png, _ in results}
+    assert all(png is not None and png == pngs[number] for _, number, png, _ in results)
+
+
+ROWS = list(enumerate(['1', '2', '1', '3', '2', '1', '4', '3'], start=1))
+
+
+def test_duplicates_in_one_render_are_rendered_once(render_calls):
+    # Repeats inside a batch and across batches both come from the cache
+    cache = RenderCache(memory_bytes=1024 * 1024)
+    check_results(list(RenderEngine(workers=1, batch_size=3, cache=cache).render(ROWS)), ROWS)
+    assert sorted(render_calls) == ['1', '2', '3', '4']
+    stats = cache.stats()
+    # Batches of 3: "1" repeats within the first; "2", "1" and "3" later hit the cache
+    assert (stats['misses'], stats['memory_hits']) == (4, 3)
+    # A second job is served from the cache entirely
+    check_results(list(RenderEngine(workers=1, batch_size=3, cache=cache).render(ROWS)), ROWS)
+    assert len(render_calls) == 4
+
+
+def test_duplicates_in_one_batch_are_rendered_once_without_cache(render_calls):
+    check_results(list(RenderEngine(workers=1, batch_size=len(ROWS)).render(ROWS)), ROWS)
+    assert sorted(render_calls) == ['1', '2', '3', '4']
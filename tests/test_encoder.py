@@ -0,0 +1,77 @@
+# tests/test_encoder.py
+import random
+
+import numpy as np
+import pytest
+import qrcode
+
+import encoder
+from encoder import MAX_VERSION, encode_batch, make_modules
+
+LEVELS = {
+    'L': qrcode.constants.ERROR_CORRECT_L,
+    'M': qrcode.constants.ERROR_CORRECT_M,
+    'Q': qrcode.constants.ERROR_CORRECT_Q,
+    'H': qrcode.constants.ERROR_CORRECT_H,
+}
+
+
+def boundary_lengths(error_correction):
+    # The longest and shortest numeric payloads of every batch-encoded
+    # version, plus the first length that falls back to the library
+    lengths = set()
+    previous = None
+    for length in range(1, 1024):
+        version = encoder._numeric_version(length, error_correction)
+        if version != previous:
+            lengths.update((length - 1, length))
+            previous = version
+        if version is None:
+            break
+    return sorted(n for n in lengths if n > 0)
+
+
+def assert_matches_library(values, error_correction, border):
+    for value, modules in zip(values, encode_batch(values, error_correction, border)):
+        expected = np.asarray(make_modules(value, error_correction, border), dtype=bool)
+        assert np.array_equal(modules, expected), value
+
+
+@pytest.mark.parametrize('level', sorted(LEVELS))
+@pytest.mark.parametrize('border', [0, 2, 4])
+def test_numeric_payloads_match_library(level, border):
+    rng = random.Random(f'{level}{border}')
+    values = [str(n) for n in range(0, 1000, 7)] + ['0', '00', '007', '0000000000']
+    values += [''.join(rng.choice('0123456789') for _ in range(length))
+               for length in boundary_lengths(LEVELS[level]) for _ in range(3)]
+    assert_matches_library(values, LEVELS[level], border)
+
+
+@pytest.mark.parametrize('level', sorted(LEVELS))
+def test_fallback_payloads_match_library(level):
+    # Non-numeric text, non-ASCII digits and payloads past MAX_VERSION take
+    # the library path inside the same batch
+    long_number = '9' * (boundary_lengths(LEVELS[level])[-1] + 5)
+    values = ['A-1', '12 34', 'café', '١٢٣', '', long_number, '42', 12345]
+    assert encoder._numeric_version(len(long_number), LEVELS[level]) is None
+    assert_matches_library(values, LEVELS[level], 2)
+
+
+def test_all_versions_are_batch_encoded():
+    for error_correction in LEVELS.values():
+        versions = {encoder._numeric_version(n, error_correction) for n in boundary_lengths(error_correction)}
+        for version in versions - {None}:
+            assert encoder._layout(version, error_correction) is not None
+        assert max(versions - {None}) <= MAX_VERSION
+
+
+def test_layout_self_check_falls_back_to_library(monkeypatch):
+    # A layout that no longer agrees with the library is not used
+    original = encoder._Layout.encode
+    monkeypatch.setattr(encoder._Layout, 'encode', lambda self, digits: ~original(self, digits))
+    encoder._layout.cache_clear()
+    try:
+        assert encoder._layout(1, LEVELS['L']) is None
+        assert_matches_library(['1234', '987654321'], LEVELS['L'], 2)
+    finally:
+        encoder._layout.cache_clear()
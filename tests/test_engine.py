@@ -0,0 +1,41 @@
+# tests/test_engine.py
+import os
+import signal
+
+import pytest
+
+from engine import RenderEngine
+
+ROWS = [(i, str(i)) for i in range(1, 41)]
+
+
+@pytest.fixture
+def engine():
+    engine = RenderEngine(workers=2, batch_size=8)
+    yield engine
+    engine.shutdown()
+
+
+def kill_workers(engine):
+    for pid in list(engine._pool._processes):
+        os.kill(pid, signal.SIGKILL)
+
+
+def assert_all_rendered(results):
+    assert [row_number for row_number, _, _, _ in results] == [row for row, _ in ROWS]
+    assert all(png is not None and error is None for _, _, png, error in results)
+
+
+def test_pool_is_replaced_after_workers_die(engine):
+    assert_all_rendered(list(engine.render(ROWS)))
+    broken = engine._pool
+    kill_workers(engine)
+    assert_all_rendered(list(engine.render(ROWS)))
+    assert engine._pool is not broken
+
+
+def test_batches_in_flight_are_retried_when_workers_die(engine):
+    results = engine.render(ROWS)
+    first = next(results)
+    kill_workers(engine)
+    assert_all_rendered([first] + list(results))
@@ -0,0 +1,105 @@
+# tests/test_ingest.py
+import io
+import os
+import zipfile
+
+import pytest
+
+import app as app_module
+
+from ingest import IngestError, detect_encoding, normalize_header, read_tiffin_rows
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def rows(data, **kwargs):
+    return list(read_tiffin_rows(io.BytesIO(data), **kwargs))
+
+
+def test_thaali_sheet():
+    # Multi-line "Tiffin \nnumber" header, then a member sub-header row whose
+    # tiffin cell is empty
+    with open(os.path.join(ROOT, 'Thaali NumberNameID Number.csv'), 'rb') as f:
+        assert list(read_tiffin_rows(f)) == [(1, '1'), (2, '2')]
+
+
+def test_sample_template():
+    with open(os.path.join(ROOT, 'static', 'sample_template.csv'), 'rb') as f:
+        assert list(read_tiffin_rows(f)) == []
+
+
+def test_header_names_are_normalized():
+    assert normalize_header(' Tiffin \nNUMBER ') == normalize_header('Tiffin Number')
+    assert rows(b'Name, tiffin  number \nA,7\n') == [(1, '7')]
+
+
+def test_header_is_searched_for_below_title_rows():
+    data = b'Thaali list\n\nName,Tiffin Number\nA,1\n'
+    assert rows(data) == [(1, '1')]
+    title_rows = b'title\n' * 10
+    with pytest.raises(IngestError, match='header named "Tiffin Number"'):
+        rows(title_rows + b'Tiffin Number\n1\n')
+
+
+def test_blank_rows_and_cells_are_skipped():
+    data = b'Tiffin Number,Name\n1,A\n\n,B\n  ,C\n 2 ,D\nshort\n'
+    assert rows(data) == [(1, '1'), (2, '2'), (3, 'short')]
+
+
+def test_custom_column():
+    # Any of the accepted names matches; the leftmost matching cell wins
+    data = b'ID Number,Tiffin Number\nX-1,1\nX-2,2\n'
+    assert rows(data, columns=('ID Number', 'Tiffin Number')) == [(1, 'X-1'), (2, 'X-2')]
+    assert rows(b'Tiffin Number\n5\n', columns=('ID Number', 'Tiffin Number')) == [(1, '5')]
+    with pytest.raises(IngestError, match='header named "ID Number"'):
+        rows(b'Tiffin Number\n5\n', columns=('ID Number',))
+
+
+@pytest.mark.parametrize('newline', [b'\n', b'\r\n', b'\r'])
+def test_line_endings(newline):
+    data = newline.join([b'Tiffin Number', b'1', b'"2"', b'3']) + newline
+    assert rows(data) == [(1, '1'), (2, '2'), (3, '3')]
+
+
+def test_utf8_with_bom():
+    assert rows('﻿Tiffin Number\ncafé\n'.encode('utf-8')) == [(1, 'café')]
+
+
+def test_cp1252_fallback():
+    data = 'Tiffin Number\ncafé\n12\n'.encode('cp1252')
+    assert detect_encoding(io.BytesIO(data)) == 'cp1252'
+    assert rows(data) == [(1, 'café'), (2, '12')]
+
+
+def test_undecodable_bytes_are_an_error():
+    # 0x81 is unassigned in cp1252 too
+    with pytest.raises(IngestError, match='Failed to read CSV file'):
+        rows(b'Tiffin Number\n1\n\x81\n')
+
+
+def test_malformed_line_after_the_header():
+    data = b'Tiffin Number\n1\n2\n"' + b'x' * 200000 + b'"\n3\n'
+    values = read_tiffin_rows(io.BytesIO(data))
+    assert next(values) == (1, '1')
+    with pytest.raises(IngestError, match='after row 2.*field larger than field limit'):
+        list(values)
+
+
+def test_stream_is_left_open():
+    stream = io.BytesIO(b'Tiffin Number\n1\n2\n')
+    values = read_tiffin_rows(stream)
+    next(values)
+    del values
+    assert not stream.closed
+    stream.seek(0)
+    assert len(list(read_tiffin_rows(stream))) == 2
+
+
+def test_column_form_field():
+    client = app_module.app.test_client()
+    data = b'Name,ID Number\nA,X-1\n'
+    response = client.post('/generate', data={'file': (io.BytesIO(data), 'ids.csv'), 'column': 'ID Number'})
+    assert response.mimetype == 'application/zip'
+    assert zipfile.ZipFile(io.BytesIO(response.data)).namelist() == ['qr_1_tiffin_X-1.png']
+    response = client.post('/generate', data={'file': (io.BytesIO(data), 'ids.csv')})
+    assert response.data == b'CSV must have a header named "Tiffin Number".'
@@ -0,0 +1,78 @@
+# tests/test_jobs.py
+import io
+import os
+import threading
+import time
+import zipfile
+
+from ingest import read_tiffin_rows
+from jobs import JobManager
+
+UPLOAD = b'Tiffin Number\n1\n2\n3\n'
+
+
+def wait_for(manager, job_id, state, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = manager.status(job_id)
+        if status is not None and status['state'] == state:
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f'job {job_id} never reached {state}: {manager.status(job_id)}')
+
+
+def entries(rows, on_result, stats):
+    for row_number, tiffin_number in rows:
+        on_result(row_number, None)
+        yield f'{tiffin_number}.txt', tiffin_number.encode()
+
+
+def test_job_produces_archive(tmp_path):
+    manager = JobManager(str(tmp_path), entries)
+    job_id = manager.submit(io.BytesIO(UPLOAD), read_tiffin_rows)
+    status = wait_for(manager, job_id, 'done')
+    assert (status['rows_done'], status['rows_total']) == (3, 3)
+    with zipfile.ZipFile(manager.archive_path(job_id)) as archive:
+        assert archive.namelist() == ['1.txt', '2.txt', '3.txt']
+
+
+def test_queued_jobs_outlive_ttl(tmp_path):
+    # One job worker, held busy, and a ttl that has already passed for the
+    # job queued behind it
+    release = threading.Event()
+
+    def blocking(rows, on_result, stats):
+        release.wait(10)
+        yield from entries(rows, on_result, stats)
+
+    manager = JobManager(str(tmp_path), blocking, workers=1, ttl=0)
+    running = manager.submit(io.BytesIO(UPLOAD), read_tiffin_rows)
+    queued = manager.submit(io.BytesIO(UPLOAD), read_tiffin_rows)
+    time.sleep(0.1)
+    manager._last_purge = 0
+    manager.purge_expired()
+    assert os.path.isdir(os.path.join(tmp_path, queued))
+    release.set()
+    for job_id in (running, queued):
+        assert wait_for(manager, job_id, 'done')['rows_done'] == 3
+
+
+def test_orphaned_jobs_are_purged(tmp_path):
+    # A job left unfinished by a process that has since exited
+    manager = JobManager(str(tmp_path), entries, ttl=0)
+    job_id = '0' * 32
+    os.makedirs(os.path.join(tmp_path, job_id))
+    manager._write_status(job_id, {'job_id': job_id, 'state': 'running', 'pid': 0x7fffffff})
+    time.sleep(0.01)
+    manager.purge_expired()
+    assert not os.path.exists(os.path.join(tmp_path, job_id))
+
+
+def test_failures_are_recorded(tmp_path):
+    def failing(rows, on_result, stats):
+        raise RuntimeError('disk full')
+        yield
+
+    manager = JobManager(str(tmp_path), failing)
+    job_id = manager.submit(io.BytesIO(UPLOAD), read_tiffin_rows)
+    assert wait_for(manager, job_id, 'failed')['failure'] == 'disk full'
@@ -0,0 +1,68 @@
+# tests/test_metrics.py
+import json
+import os
+
+from metrics import Registry, RequestStats
+
+
+def finished_request(output, rows, failures=0):
+    stats = RequestStats(output)
+    for row in range(rows):
+        stats.observe_row(0.002, 'error' if row < failures else None)
+    stats.bytes = 100 * rows
+    return stats
+
+
+def metric(text, name):
+    for line in text.splitlines():
+        if line.startswith(name + ' '):
+            return float(line.split()[-1])
+    raise KeyError(name)
+
+
+def cache_stats(hits, memory_bytes):
+    return lambda: {'memory_hits': hits, 'disk_hits': 0, 'misses': 1, 'memory_evictions': 0,
+                    'disk_evictions': 0, 'memory_bytes': memory_bytes}
+
+
+def test_processes_sharing_a_directory_are_summed(tmp_path):
+    first, second = Registry(), Registry()
+    first.share(str(tmp_path), cache_stats=cache_stats(2, 1000))
+    second.share(str(tmp_path), cache_stats=cache_stats(3, 500))
+    first.record(finished_request('zip', 10, failures=1))
+    second.record(finished_request('pdf', 5))
+
+    for registry in (first, second):
+        text = registry.render()
+        assert metric(text, 'qr_requests_total{output="zip"}') == 1
+        assert metric(text, 'qr_requests_total{output="pdf"}') == 1
+        assert metric(text, 'qr_rows_total') == 15
+        assert metric(text, 'qr_row_failures_total') == 1
+        assert metric(text, 'qr_output_bytes_total') == 1500
+        assert metric(text, 'qr_row_seconds_count') == 15
+        assert metric(text, 'qr_cache_hits_total{tier="memory"}') == 5
+        assert metric(text, 'qr_cache_bytes{tier="memory"}') == 1500
+
+
+def test_exited_processes_keep_counters_but_not_gauges(tmp_path):
+    registry = Registry()
+    registry.share(str(tmp_path), cache_stats=cache_stats(1, 200))
+    registry.record(finished_request('zip', 4))
+    # A worker that has since exited; pid 0x7fffffff is never a live process
+    dead = {'pid': 0x7fffffff, 'requests': {'zip': 2}, 'rows': 6, 'failures': 0, 'bytes': 0,
+            'stage_seconds': {}, 'bucket_counts': [0] * 11, 'latency_sum': 0.0, 'latency_count': 6,
+            'cache': cache_stats(7, 9999)()}
+    with open(os.path.join(tmp_path, 'dead.json'), 'w') as f:
+        json.dump(dead, f)
+
+    text = registry.render()
+    assert metric(text, 'qr_requests_total{output="zip"}') == 3
+    assert metric(text, 'qr_rows_total') == 10
+    assert metric(text, 'qr_cache_hits_total{tier="memory"}') == 8
+    assert metric(text, 'qr_cache_bytes{tier="memory"}') == 200
+
+
+def test_unshared_registry_reports_its_own_process():
+    registry = Registry()
+    registry.record(finished_request('zip', 3))
+    assert metric(registry.render(), 'qr_rows_total') == 3
@@ -0,0 +1,113 @@
+# tests/test_qr_api.py
+import base64
+import email
+import io
+import json
+
+import pytest
+from PIL import Image
+
+import app as app_module
+from render import render_qr_png
+
+
+@pytest.fixture
+def client():
+    return app_module.app.test_client()
+
+
+def test_single_code_is_cacheable(client):
+    response = client.get('/qr/12345')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert response.data == render_qr_png('12345')
+    assert response.get_etag() == (app_module.tile_cache_key('12345'), False)
+    assert response.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+
+
+@pytest.mark.parametrize('template', ['"{}"', 'W/"{}"', '"other", "{}"', '*'])
+def test_matching_if_none_match_is_not_modified(client, template):
+    etag = client.get('/qr/12345').get_etag()[0]
+    response = client.get('/qr/12345', headers={'If-None-Match': template.format(etag)})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.get_etag() == (etag, False)
+
+
+def test_other_etag_or_style_is_rendered(client):
+    etag = client.get('/qr/12345').get_etag()[0]
+    assert client.get('/qr/12345', headers={'If-None-Match': '"other"'}).status_code == 200
+    response = client.get('/qr/12345?ec=H', headers={'If-None-Match': f'"{etag}"'})
+    assert response.status_code == 200
+    assert response.get_etag()[0] != etag
+
+
+def test_svg_and_style_parameters(client):
+    response = client.get('/qr/hello%20world?format=svg&ec=Q&box_size=4&border=0&label=off')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/svg+xml'
+    assert response.data.startswith(b'<svg')
+    assert b'<text' not in response.data
+    # Without the label strip the tile is square: 21 modules plus the border, 3px each
+    png = client.get('/qr/7?box_size=3&label=0')
+    assert Image.open(io.BytesIO(png.data)).size == (75, 75)
+
+
+@pytest.mark.parametrize('query', ['format=gif', 'ec=Z', 'box_size=abc', 'box_size=0',
+                                   'box_size=41', 'border=-1', 'border=21'])
+def test_bad_parameters_are_rejected(client, query):
+    response = client.get(f'/qr/12345?{query}')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_long_payload_is_rejected(client):
+    assert client.get('/qr/' + 'a' * 1001).status_code == 400
+
+
+def test_batch_streams_ndjson(client):
+    response = client.post('/qr/batch', json={'payloads': ['1', 22, 'abc', '1'], 'ec': 'M'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [(line['index'], line['payload']) for line in lines] == [(0, '1'), (1, '22'), (2, 'abc'), (3, '1')]
+    for line in lines:
+        assert line['content_type'] == 'image/png'
+        assert line['etag'] == client.get(f"/qr/{line['payload']}?ec=M").get_etag()[0]
+        assert base64.b64decode(line['data']) == client.get(f"/qr/{line['payload']}?ec=M").data
+
+
+def test_batch_accepts_a_bare_list_and_svg(client):
+    response = client.post('/qr/batch', json=['7'])
+    assert json.loads(response.data)['payload'] == '7'
+    response = client.post('/qr/batch', json={'payloads': ['7'], 'format': 'svg'})
+    line = json.loads(response.data)
+    assert line['content_type'] == 'image/svg+xml'
+    assert base64.b64decode(line['data']).startswith(b'<svg')
+
+
+def test_batch_streams_multipart_when_asked(client):
+    response = client.post('/qr/batch', json=['7', '8'], headers={'Accept': 'multipart/mixed'})
+    assert response.mimetype == 'multipart/mixed'
+    message = email.message_from_bytes(
+        f'Content-Type: {response.headers["Content-Type"]}\r\n\r\n'.encode() + response.data)
+    parts = message.get_payload()
+    assert [part['X-QR-Index'] for part in parts] == ['0', '1']
+    for part, payload in zip(parts, ['7', '8']):
+        assert part.get_content_type() == 'image/png'
+        assert part['ETag'] == f'"{app_module.tile_cache_key(payload)}"'
+        assert part.get_payload(decode=True) == render_qr_png(payload)
+
+
+@pytest.mark.parametrize('body', [None, {}, [], {'payloads': 'x'}, [None], [True], [[1]], [{'a': 1}]])
+def test_batch_rejects_bad_bodies(client, body):
+    response = client.post('/qr/batch', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_batch_limits(client, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'QR_BATCH_MAX_PAYLOADS', 2)
+    assert client.post('/qr/batch', json=['1', '2', '3']).status_code == 400
+    assert client.post('/qr/batch', json=['a' * 1001]).status_code == 400
+    assert client.post('/qr/batch', data='not json').status_code == 400
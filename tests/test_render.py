@@ -0,0 +1,64 @@
+# tests/test_render.py
+import io
+import os
+
+import numpy as np
+import pytest
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+
+import render
+from render import LabelRenderer, load_font, render_qr_png
+
+FONT_DIR = '/usr/share/fonts/truetype/dejavu'
+FONTS = [None, 'DejaVuSans.ttf', 'DejaVuSans-Bold.ttf', 'DejaVuSerif.ttf']
+PAYLOADS = ['1', '42', '12345', '0987654321', '1111111', 'A-1', 'café', 'TIFFIN-000123-XYZ']
+
+
+def reference_png(tiffin_number, font):
+    # The tile as /generate drew it before the NumPy renderer: qrcode's own
+    # image with a label drawn by ImageDraw.text
+    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L,
+                       box_size=6, border=2)
+    qr.add_data(str(tiffin_number))
+    qr.make(fit=True)
+    qr_img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
+    final_img = Image.new("RGB", (qr_img.width, qr_img.height + 50), "white")
+    final_img.paste(qr_img, (0, 0))
+    draw = ImageDraw.Draw(final_img)
+    label_text = f"Tiffin #: {tiffin_number}"
+    text_box = draw.textbbox((0, 0), label_text, font=font)
+    text_width = text_box[2] - text_box[0]
+    draw.text(((qr_img.width - text_width) // 2, qr_img.height + 10),
+              label_text, fill="black", font=font)
+    img_byte_arr = io.BytesIO()
+    final_img.save(img_byte_arr, format='PNG')
+    return img_byte_arr.getvalue()
+
+
+def pixels(png):
+    return np.asarray(Image.open(io.BytesIO(png)).convert('RGB'))
+
+
+@pytest.fixture(params=FONTS)
+def font(request, monkeypatch):
+    if request.param is None:
+        font = load_font()
+    else:
+        path = os.path.join(FONT_DIR, request.param)
+        if not os.path.exists(path):
+            pytest.skip(f'{request.param} is not installed')
+        font = ImageFont.truetype(path, render.FONT_SIZE)
+    monkeypatch.setattr(render, '_label_renderer', LabelRenderer(font))
+    return font
+
+
+@pytest.mark.parametrize('fast', [True, False])
+def test_tiles_are_pixel_identical_to_reference(font, fast):
+    renderer = render.get_label_renderer()
+    if fast and not renderer.fast:
+        pytest.skip('glyph compositing is not exact for this font')
+    renderer.fast = fast
+    for tiffin_number in PAYLOADS:
+        assert np.array_equal(pixels(render_qr_png(tiffin_number)),
+                              pixels(reference_png(tiffin_number, font))), tiffin_number
@@ -0,0 +1,50 @@
+# zipstream.py
+import io
+import zipfile
+
+from metrics import NULL_TIMER
+
+
+class _ChunkSink(io.RawIOBase):
+    # Write-only, non-seekable file object. zipfile falls back to data
+    # descriptors for it, so nothing already written is ever revisited and
+    # the buffered bytes can be handed out and dropped after every entry.
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def stream_zip(entries, compression=zipfile.ZIP_STORED, timer=NULL_TIMER):
+    """Yield a ZIP archive chunk by chunk from an iterable of (name, bytes).
+
+    Only the entry currently being written plus the central directory are
+    held in memory, regardless of how many entries there are.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=compression) as zipf:
+        for name, data in entries:
+            with timer.stage('zip_write'):
+                zipf.writestr(name, data)
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    chunk = sink.drain()
+    if chunk:
+        yield chunk